@@ -1,6 +1,7 @@
 from typing import Optional, Tuple, Union
 import math
 import torch
+import torch.nn.functional as F
 from torch import nn
 
 class ConvolutionModule(nn.Module):
@@ -418,22 +419,40 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         q_with_bias_v = (q + self.pos_bias_v).transpose(1, 2)
 
         # compute attention score
-        # first compute matrix a and matrix c
+        # matrix a and matrix c (q_u @ k) are computed inside sdpa below,
         # as described in https://arxiv.org/abs/1901.02860 Section 3.3
-        # (batch, head, time1, time2)
-        matrix_ac = torch.matmul(q_with_bias_u, k.transpose(-2, -1))
 
         # compute matrix b and matrix d
         # (batch, head, time1, time2)
         matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
         # NOTE(Xiang Lyu): Keep rel_shift since espnet rel_pos_emb is used
-        if matrix_ac.shape != matrix_bd.shape:
+        if matrix_bd.size(-1) != k.size(2):
             matrix_bd = self.rel_shift(matrix_bd)
 
-        scores = (matrix_ac + matrix_bd) / math.sqrt(
-            self.d_k)  # (batch, head, time1, time2)
-
-        return self.forward_attention(v, scores, mask), new_cache
+        # the position term and the padding mask go in as an additive bias so
+        # the q_u @ k product, softmax and value product run as one sdpa kernel
+        attn_bias = matrix_bd / math.sqrt(self.d_k)  # (batch, head, time1, time2)
+        fully_masked = None
+        if mask.size(2) > 0:  # time2 > 0
+            mask = mask.unsqueeze(1).eq(0)  # (batch, 1, *, time2)
+            # For last chunk, time2 might be larger than scores.size(-1)
+            mask = mask[:, :, :, :attn_bias.size(-1)]  # (batch, 1, *, time2)
+            attn_bias = attn_bias.masked_fill(mask, torch.finfo(attn_bias.dtype).min)
+            # rows without any valid key attend to nothing, as in forward_attention
+            fully_masked = mask.all(dim=-1, keepdim=True)
+
+        x = F.scaled_dot_product_attention(
+            q_with_bias_u,
+            k,
+            v,
+            attn_mask=attn_bias,
+            dropout_p=self.dropout.p if self.training else 0.0,
+        )  # (batch, head, time1, d_k)
+        if fully_masked is not None:
+            x = x.masked_fill(fully_masked, 0.0)
+        x = x.transpose(1, 2).contiguous().view(x.size(0), -1, self.h * self.d_k)
+
+        return self.linear_out(x), new_cache
 
 
 
@@ -53,10 +53,38 @@ def apg_forward(
     return pred_guided
 
 
+def is_unit_guidance(guidance_scale, eps=1e-4):
+    # cfg and apg reduce to the cond prediction only at exactly 1; below 1 they still mix in uncond
+    return abs(guidance_scale - 1.0) <= eps
+
+
 def cfg_forward(cond_output, uncond_output, cfg_strength):
     return uncond_output + cfg_strength * (cond_output - uncond_output)
 
 
+def apply_guidance(noise_pred, guidance_scale, cfg_type, momentum_buffer=None):
+    noise_pred_with_cond, noise_pred_uncond = noise_pred.chunk(2)
+    if cfg_type == "apg":
+        return apg_forward(
+            pred_cond=noise_pred_with_cond,
+            pred_uncond=noise_pred_uncond,
+            guidance_scale=guidance_scale,
+            momentum_buffer=momentum_buffer,
+        )
+    elif cfg_type == "cfg":
+        return cfg_forward(
+            cond_output=noise_pred_with_cond,
+            uncond_output=noise_pred_uncond,
+            cfg_strength=guidance_scale,
+        )
+    return noise_pred
+
+
+# fuses the small guidance kernels; shapes are fixed for a run so no dynamic shapes.
+# no cudagraphs: the momentum buffer keeps the output alive across steps
+compiled_apply_guidance = torch.compile(apply_guidance, dynamic=False)
+
+
 def cfg_double_condition_forward(
     cond_output,
     uncond_output,
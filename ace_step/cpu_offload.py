@@ -1,43 +1,121 @@
 import torch
 import functools
-from typing import Callable, TypeVar
+import contextlib
+from loguru import logger
+from typing import Callable, Optional, TypeVar
+
+
+def pin_memory(model):
+    """Move the CPU weights of `model` to page-locked memory so uploads can run async."""
+    if hasattr(model, "torchao_quantized") or not torch.cuda.is_available():
+        return model
+    try:
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            if tensor.device.type == "cpu" and not tensor.is_pinned():
+                tensor.data = tensor.data.pin_memory()
+    except RuntimeError as e:
+        # low-RAM hosts may refuse to lock this much memory; keep the rest pageable
+        logger.warning(f"failed to pin offloaded weights, falling back to pageable memory: {e}")
+    return model
 
 
 class CpuOffloader:
-    def __init__(self, model, device="cpu"):
+    def __init__(self, model, device="cpu", stream=None):
         self.model = model
         self.original_device = device
         self.original_dtype = model.dtype
-    
+        # side stream used to upload weights while the previous module computes
+        self.stream = stream
+        self.depth = 0
+        self.loaded = False
+        self._pending = False
+        # id(tensor) -> (tensor, host copy); the host copy is reused on every offload
+        self._host_tensors = {}
+
+    def _tensors(self):
+        yield from self.model.parameters()
+        yield from self.model.buffers()
+
+    def _skip(self):
+        return hasattr(self.model, "torchao_quantized")
+
+    def _host_copy(self, tensor):
+        entry = self._host_tensors.get(id(tensor))
+        if entry is None or entry[0] is not tensor:
+            host = tensor.data if tensor.device.type == "cpu" else tensor.data.to("cpu")
+            entry = (tensor, host)
+            self._host_tensors[id(tensor)] = entry
+        return entry[1]
+
+    def prefetch(self):
+        """Queue the host-to-device copy of the weights without waiting for it."""
+        if self.loaded or self._skip():
+            return
+        non_blocking = self.stream is not None
+        ctx = torch.cuda.stream(self.stream) if non_blocking else contextlib.nullcontext()
+        with ctx:
+            for tensor in self._tensors():
+                host = self._host_copy(tensor)
+                tensor.data = host.to(self.original_device, non_blocking=non_blocking)
+        self.loaded = True
+        self._pending = non_blocking
+
+    def wait(self):
+        if not self._pending:
+            return
+        current = torch.cuda.current_stream(self.stream.device)
+        current.wait_stream(self.stream)
+        # the weights were allocated on the side stream but are consumed here
+        for tensor in self._tensors():
+            tensor.data.record_stream(current)
+        self._pending = False
+
+    def offload(self):
+        if self.loaded and not self._skip():
+            # weights are frozen, so dropping the device copy is enough
+            for tensor in self._tensors():
+                tensor.data = self._host_copy(tensor)
+        self.loaded = False
+        self._pending = False
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
     def __enter__(self):
-        if not hasattr(self.model,"torchao_quantized"):
-            self.model.to(self.original_device, dtype=self.original_dtype)
+        if self.depth == 0:
+            self.prefetch()
+            self.wait()
+        self.depth += 1
         return self.model
-    
+
     def __exit__(self, *args):
-        if not hasattr(self.model,"torchao_quantized"):
-            self.model.to("cpu")
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
+        self.depth -= 1
+        if self.depth == 0:
+            self.offload()
+
+
+def get_offloader(pipeline, model_attr: str) -> CpuOffloader:
+    model = getattr(pipeline, model_attr)
+    offloader = pipeline._offloaders.get(model_attr)
+    if offloader is None or offloader.model is not model:
+        offloader = CpuOffloader(model, pipeline.device, pipeline._offload_stream)
+        pipeline._offloaders[model_attr] = offloader
+    return offloader
 
 
 T = TypeVar('T')
 
-def cpu_offload(model_attr: str):
+def cpu_offload(model_attr: str, prefetch: Optional[str] = None):
     def decorator(func: Callable[..., T]) -> Callable[..., T]:
         @functools.wraps(func)
         def wrapper(self, *args, **kwargs):
             if not self.cpu_offload:
                 return func(self, *args, **kwargs)
 
-            # Get the device from the class
-            device = self.device
-            # Get the model from the class attribute
-            model = getattr(self, model_attr)
-            
-            with CpuOffloader(model, device):
+            with get_offloader(self, model_attr):
+                # start uploading the module used next so it overlaps with this one
+                if prefetch is not None:
+                    get_offloader(self, prefetch).prefetch()
                 return func(self, *args, **kwargs)
-                        
+
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
@@ -2,6 +2,8 @@ import random
 import time
 import os
 import re
+import functools
+import contextlib
 import torch
 from loguru import logger
 from tqdm import tqdm
@@ -14,8 +16,186 @@ from ace_step.schedulers.scheduling_flow_match_euler_discrete import FlowMatchEu
 from ace_step.schedulers.scheduling_flow_match_heun_discrete import FlowMatchHeunDiscreteScheduler
 from ace_step.language_segmentation import LangSegment
 from ace_step.ace_models.lyrics_utils.lyric_tokenizer import VoiceBpeTokenizer
-from ace_step.apg_guidance import apg_forward, MomentumBuffer, cfg_forward, cfg_zero_star, cfg_double_condition_forward
-from ace_step.cpu_offload import cpu_offload
+from ace_step.apg_guidance import apg_forward, MomentumBuffer, cfg_forward, cfg_zero_star, cfg_double_condition_forward, apply_guidance, compiled_apply_guidance, is_unit_guidance
+from ace_step.cpu_offload import cpu_offload, pin_memory
+from ace_step.step_cache import StepCache
+from ace_step.cuda_graph import GraphedDecode
+
+STRUCTURE_PATTERN = re.compile(r"^\[.*?\]")
+
+SCHEDULERS = {
+    "euler": FlowMatchEulerDiscreteScheduler,
+    "heun": FlowMatchHeunDiscreteScheduler,
+}
+
+
+@functools.lru_cache(maxsize=32)
+def _cached_schedule(scheduler_type, infer_steps, oss_steps, dtype):
+    # timesteps/sigmas only depend on the arguments, so compute them once on the CPU
+    if len(oss_steps) > 0:
+        infer_steps = max(oss_steps)
+    scheduler = SCHEDULERS[scheduler_type](num_train_timesteps=1000, shift=3.0)
+    timesteps, num_inference_steps = retrieve_timesteps(
+        scheduler,
+        num_inference_steps=infer_steps,
+        device="cpu",
+        timesteps=None,
+    )
+    if len(oss_steps) > 0:
+        new_timesteps = torch.zeros(len(oss_steps), dtype=dtype)
+        for idx in range(len(oss_steps)):
+            new_timesteps[idx] = timesteps[oss_steps[idx] - 1]
+        sigmas = (new_timesteps / 1000).float().numpy()
+        timesteps, num_inference_steps = retrieve_timesteps(
+            scheduler,
+            num_inference_steps=len(oss_steps),
+            device="cpu",
+            sigmas=sigmas,
+        )
+    return scheduler.timesteps, scheduler.sigmas, num_inference_steps
+
+
+def get_scheduler(scheduler_type, infer_steps, device, dtype, oss_steps=()):
+    timesteps, sigmas, num_inference_steps = _cached_schedule(
+        scheduler_type, infer_steps, tuple(oss_steps), dtype
+    )
+    scheduler = SCHEDULERS[scheduler_type](num_train_timesteps=1000, shift=3.0)
+    scheduler.num_inference_steps = num_inference_steps
+    scheduler.timesteps = timesteps.to(device, copy=True)
+    scheduler.sigmas = sigmas.to(device, copy=True)
+    if scheduler.order == 2:
+        # state normally reset by FlowMatchHeunDiscreteScheduler.set_timesteps
+        scheduler.prev_derivative = None
+        scheduler.dt = None
+    return scheduler, scheduler.timesteps, num_inference_steps
+
+
+def cat_padded(tensors):
+    # concatenate along the batch dim, right-padding dim 1 with zeros to the longest input
+    length = max(tensor.shape[1] for tensor in tensors)
+    padded = []
+    for tensor in tensors:
+        if tensor.shape[1] < length:
+            shape = list(tensor.shape)
+            shape[1] = length - tensor.shape[1]
+            tensor = torch.cat([tensor, tensor.new_zeros(shape)], dim=1)
+        padded.append(tensor)
+    return torch.cat(padded, dim=0)
+
+
+def merge_src_tar_conditioning(
+    attention_mask,
+    encoder_text_hidden_states,
+    text_attention_mask,
+    speaker_embds,
+    lyric_token_ids,
+    lyric_mask,
+    target_encoder_text_hidden_states,
+    target_text_attention_mask,
+    target_speaker_embeds,
+    target_lyric_token_ids,
+    target_lyric_mask,
+):
+    # transformer kwargs for one batched [src, tar] pass; the conditioning is fixed for a whole edit
+    return dict(
+        attention_mask=(
+            torch.cat([attention_mask, attention_mask])
+            if attention_mask is not None
+            else None
+        ),
+        encoder_text_hidden_states=cat_padded(
+            [encoder_text_hidden_states, target_encoder_text_hidden_states]
+        ),
+        text_attention_mask=cat_padded([text_attention_mask, target_text_attention_mask]),
+        speaker_embeds=torch.cat([speaker_embds, target_speaker_embeds]),
+        lyric_token_idx=cat_padded([lyric_token_ids, target_lyric_token_ids]),
+        lyric_mask=cat_padded([lyric_mask, target_lyric_mask]),
+    )
+
+
+@contextlib.contextmanager
+def query_temperature(linears, tau):
+    # fold tau into the q projection weights instead of rescaling every output from a hook
+    restore = []
+    handles = []
+    try:
+        for linear in linears:
+            if hasattr(linear, "base_layer") or type(linear.weight.data) is not torch.Tensor:
+                # peft LoRA wrappers add their delta on top of base_layer.weight, and quantized
+                # weights can't be rescaled in place; scale the whole output for those instead
+                handles.append(linear.register_forward_hook(lambda module, input, output: output * tau))
+                continue
+            restore.append((linear, linear.weight.data, None if linear.bias is None else linear.bias.data))
+            # parameters must not end up holding inference tensors, build the scaled copies outside it
+            with torch.inference_mode(False), torch.no_grad():
+                linear.weight.data = linear.weight.data * tau
+                if linear.bias is not None:
+                    linear.bias.data = linear.bias.data * tau
+        yield
+    finally:
+        for linear, weight, bias in restore:
+            linear.weight.data = weight
+            if bias is not None:
+                linear.bias.data = bias
+        for handle in handles:
+            handle.remove()
+
+
+def repaint_step(latents, noise_pred, x0, z0, repaint_mask, t_i, t_im1):
+    # fp32 euler step, then pin the frames outside the mask to the source trajectory
+    prev_sample = torch.addcmul(latents, noise_pred, t_im1 - t_i)
+    zt_src = torch.lerp(x0, z0, t_im1.to(x0.dtype))
+    return torch.where(repaint_mask, prev_sample, zt_src)
+
+
+def pad_to_multiple(tensor, multiple, dim=1):
+    # zero-pad `dim` up to the next multiple so compiled graphs only see a few distinct lengths
+    remainder = tensor.shape[dim] % multiple
+    if remainder == 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = multiple - remainder
+    return torch.cat([tensor, tensor.new_zeros(shape)], dim=dim)
+
+
+def randn_into(out, generator=None):
+    # fill a reused buffer with the same draws randn_tensor would make
+    if not isinstance(generator, list):
+        return out.normal_(generator=generator)
+    for sample, sample_generator in zip(out, generator):
+        if sample_generator.device.type == sample.device.type:
+            sample.normal_(generator=sample_generator)
+        else:
+            noise = torch.randn(
+                sample.shape,
+                generator=sample_generator,
+                device=sample_generator.device,
+                dtype=sample.dtype,
+            )
+            if sample.device.type == "cuda":
+                # CPU generator: stage through pinned memory so the upload does not block
+                sample.copy_(noise.pin_memory(), non_blocking=True)
+            else:
+                sample.copy_(noise)
+    return out
+
+
+def inputs_to_device(inputs, device):
+    # copy tokenizer output from pinned memory so the host does not wait on the transfer
+    if torch.device(device).type != "cuda":
+        return {key: value.to(device) for key, value in inputs.items()}
+    return {
+        key: value.pin_memory().to(device, non_blocking=True)
+        for key, value in inputs.items()
+    }
+
+
+def with_uncond(tensor):
+    # append an all-zero unconditional batch without a zeros_like temporary
+    out = tensor.new_zeros((2 * tensor.shape[0], *tensor.shape[1:]))
+    out[: tensor.shape[0]].copy_(tensor)
+    return out
+
 
 SUPPORT_LANGUAGES = {
     "en": 259, "de": 260, "fr": 262, "es": 284, "it": 285, 
@@ -24,46 +204,83 @@ SUPPORT_LANGUAGES = {
     "ko": 6152, "hi": 6680
 }
 
+# detector codes that map onto a supported tokenizer language
+LANG_ALIASES = {"zh-cn": "zh", "zh-tw": "zh", "spa": "es"}
+
+# LangSegment indexes and joins its filters, so this stays an ordered tuple
+LANG_FILTERS = (
+    'af', 'am', 'an', 'ar', 'as', 'az', 'be', 'bg', 'bn', 'br', 'bs', 'ca', 'cs', 'cy', 'da', 'de', 'dz', 'el',
+    'en', 'eo', 'es', 'et', 'eu', 'fa', 'fi', 'fo', 'fr', 'ga', 'gl', 'gu', 'he', 'hi', 'hr', 'ht', 'hu', 'hy',
+    'id', 'is', 'it', 'ja', 'jv', 'ka', 'kk', 'km', 'kn', 'ko', 'ku', 'ky', 'la', 'lb', 'lo', 'lt', 'lv', 'mg',
+    'mk', 'ml', 'mn', 'mr', 'ms', 'mt', 'nb', 'ne', 'nl', 'nn', 'no', 'oc', 'or', 'pa', 'pl', 'ps', 'pt', 'qu',
+    'ro', 'ru', 'rw', 'se', 'si', 'sk', 'sl', 'sq', 'sr', 'sv', 'sw', 'ta', 'te', 'th', 'tl', 'tr', 'ug', 'uk',
+    'ur', 'vi', 'vo', 'wa', 'xh', 'zh', 'zu'
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_lang_segment():
+    # loading the langid model is slow and LangSegment only keeps per-call state, so share one
+    lang_segment = LangSegment()
+    lang_segment.setfilters(LANG_FILTERS)
+    return lang_segment
+
 
 # class ACEStepPipeline(DiffusionPipeline):
 class ACEStepPipeline:
 
-    def __init__(self, music_dcae, ace_step, umt5encoder, text_tokenizer, device, dtype, overlapped_decode=False, **kwargs):
+    def __init__(self, music_dcae, ace_step, umt5encoder, text_tokenizer, device, dtype, overlapped_decode=False, compile_model=False, **kwargs):
         self.dtype = dtype
         self.device = device
 
-        self.cpu_offload = cpu_offload
+        # the node loader marks the transformer, like torch_compile below; unmarked models keep
+        # the offload that was always on before the flag was wired through
+        self.cpu_offload = kwargs.get("cpu_offload", getattr(ace_step, "cpu_offload", True))
+        self.parked = False
         self.overlapped_decode = overlapped_decode
+        self._offloaders = {}
+        self._offload_stream = None
+        self._attention_masks = {}
+        self._zeros = {}
+        self._pinned = {}
+        self._text_embeddings = {}
+        self._graphed_decode = None
+        if self.cpu_offload and torch.device(device).type == "cuda":
+            self._offload_stream = torch.cuda.Stream(device=device)
+        if torch.device(device).type == "cuda":
+            # tensor-core friendly accumulation; shapes are fixed within a run so let cudnn autotune
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cuda.matmul.allow_fp16_reduced_precision_reduction = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.backends.cudnn.benchmark = True
 
         self.music_dcae = music_dcae
         if self.cpu_offload: # might be redundant
-            self.music_dcae = self.music_dcae.to("cpu").eval().to(self.dtype)
+            self.music_dcae = pin_memory(self.music_dcae.to("cpu").eval().to(self.dtype))
         else:
             self.music_dcae = self.music_dcae.to(device).eval().to(self.dtype)
         # self.music_dcae.to(device).eval().to(self.dtype)
 
         self.ace_step_transformer = ace_step
         if self.cpu_offload:
-            self.ace_step_transformer = self.ace_step_transformer.to("cpu").eval().to(self.dtype)
+            self.ace_step_transformer = pin_memory(self.ace_step_transformer.to("cpu").eval().to(self.dtype))
         else:
             self.ace_step_transformer = self.ace_step_transformer.to(device).eval().to(self.dtype)
         # self.ace_step_transformer.to(device).eval().to(self.dtype)
+        # the node loader marks the transformer instead of passing the flag through
+        self.compile_model = compile_model or getattr(ace_step, "torch_compile", False)
+        # the guidance tail is only compiled when the user opted into compilation
+        self.compile_guidance = self.compile_model
+        # the loader's module outlives this pipeline, so a rebuild must not wrap the compiled methods again
+        if self.compile_model and not getattr(self.ace_step_transformer, "entry_points_compiled", False):
+            # the sampling loop calls decode/encode directly, which compiling the module's forward misses
+            self.ace_step_transformer.decode = torch.compile(self.ace_step_transformer.decode, dynamic=False)
+            self.ace_step_transformer.encode = torch.compile(self.ace_step_transformer.encode, dynamic=False)
+            self.ace_step_transformer.entry_points_compiled = True
 
-        lang_segment = LangSegment()
-
-        lang_segment.setfilters([
-            'af', 'am', 'an', 'ar', 'as', 'az', 'be', 'bg', 'bn', 'br', 'bs', 'ca', 'cs', 'cy', 'da', 'de', 'dz', 'el',
-            'en', 'eo', 'es', 'et', 'eu', 'fa', 'fi', 'fo', 'fr', 'ga', 'gl', 'gu', 'he', 'hi', 'hr', 'ht', 'hu', 'hy',
-            'id', 'is', 'it', 'ja', 'jv', 'ka', 'kk', 'km', 'kn', 'ko', 'ku', 'ky', 'la', 'lb', 'lo', 'lt', 'lv', 'mg',
-            'mk', 'ml', 'mn', 'mr', 'ms', 'mt', 'nb', 'ne', 'nl', 'nn', 'no', 'oc', 'or', 'pa', 'pl', 'ps', 'pt', 'qu',
-            'ro', 'ru', 'rw', 'se', 'si', 'sk', 'sl', 'sq', 'sr', 'sv', 'sw', 'ta', 'te', 'th', 'tl', 'tr', 'ug', 'uk',
-            'ur', 'vi', 'vo', 'wa', 'xh', 'zh', 'zu'
-        ])
-        self.lang_segment = lang_segment
-        self.lyric_tokenizer = VoiceBpeTokenizer()
         text_encoder_model = umt5encoder
         if self.cpu_offload:
-            text_encoder_model = text_encoder_model.to("cpu").eval().to(self.dtype)
+            text_encoder_model = pin_memory(text_encoder_model.to("cpu").eval().to(self.dtype))
         else:
             text_encoder_model = text_encoder_model.to(device).eval().to(self.dtype)
         # text_encoder_model = text_encoder_model.to(device).eval().to(self.dtype)
@@ -71,6 +288,15 @@ class ACEStepPipeline:
         self.text_encoder_model = text_encoder_model
         self.text_tokenizer = text_tokenizer
 
+    # only needed once lyrics are tokenized, so build them on first use
+    @functools.cached_property
+    def lang_segment(self):
+        return get_lang_segment()
+
+    @functools.cached_property
+    def lyric_tokenizer(self):
+        return VoiceBpeTokenizer()
+
     def cleanup(self):
         import gc
         self.music_dcae = None
@@ -79,10 +305,85 @@ class ACEStepPipeline:
         self.lyric_tokenizer = None
         self.text_encoder_model = None
         self.text_tokenizer = None
+        self._offloaders = {}
+        self._attention_masks = {}
+        self._zeros = {}
+        self._pinned = {}
+        self._text_embeddings = {}
+        self._graphed_decode = None
         gc.collect()
         torch.cuda.empty_cache()
 
-    @cpu_offload("text_encoder_model")
+    def to_cpu(self):
+        """Park the weights in host memory and release the device caches, keeping the pipeline."""
+        if not self.cpu_offload and not self.parked:
+            # cpu_offload already keeps the weights on the host between calls
+            for name in ("music_dcae", "ace_step_transformer", "text_encoder_model"):
+                module = getattr(self, name)
+                if module is not None:
+                    module.to("cpu")
+            self.parked = True
+        # these hold device tensors and are rebuilt on the next call
+        self._attention_masks = {}
+        self._zeros = {}
+        self._text_embeddings = {}
+        self.clear_graphs()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def to_device(self):
+        """Move weights parked by `to_cpu` back to the pipeline device."""
+        if not self.parked:
+            return
+        for name in ("music_dcae", "ace_step_transformer", "text_encoder_model"):
+            module = getattr(self, name)
+            if module is not None:
+                module.to(self.device)
+        self.parked = False
+
+    def get_attention_mask(self, bsz, frame_length, device, dtype):
+        # the latent mask is all ones; cross-attention needs a real tensor, so reuse one per shape
+        key = (bsz, frame_length, str(device), dtype)
+        mask = self._attention_masks.get(key)
+        if mask is None:
+            mask = torch.ones(bsz, frame_length, device=device, dtype=dtype)
+            self._attention_masks[key] = mask
+        return mask
+
+    def get_zeros(self, name, like):
+        # all-zero null conditioning inputs, kept across calls and resized in place
+        zeros = self._zeros.get(name)
+        if zeros is None or zeros.device != like.device or zeros.dtype != like.dtype:
+            zeros = torch.zeros_like(like)
+            self._zeros[name] = zeros
+        elif zeros.shape != like.shape:
+            zeros.resize_(like.shape).zero_()
+        return zeros
+
+    def audio_to_device(self, name, audio):
+        # queue the upload of an in-memory (waveform, sample_rate) pair without waiting on it
+        waveform, sample_rate = audio
+        if torch.device(self.device).type != "cuda" or waveform.device.type != "cpu":
+            return waveform.to(self.device), sample_rate
+        # page-locked staging kept per input; the previous call synced before returning its audio
+        staging = self._pinned.get(name)
+        if staging is None or staging.dtype != waveform.dtype or staging.numel() < waveform.numel():
+            staging = torch.empty(waveform.numel(), dtype=waveform.dtype, pin_memory=True)
+            self._pinned[name] = staging
+        staging = staging[: waveform.numel()].view(waveform.shape).copy_(waveform)
+        return staging.to(self.device, non_blocking=True), sample_rate
+
+    def get_cached_embeddings(self, key, compute, max_entries=8):
+        # the text encoder output depends only on the prompt, so a hit skips loading and running it
+        cached = self._text_embeddings.get(key)
+        if cached is None:
+            cached = compute()
+            self._text_embeddings[key] = cached
+            if len(self._text_embeddings) > max_entries:
+                self._text_embeddings.pop(next(iter(self._text_embeddings)))
+        return cached
+
+    @cpu_offload("text_encoder_model", prefetch="ace_step_transformer")
     def get_text_embeddings(self, texts, device, text_max_length=256):
         inputs = self.text_tokenizer(
             texts,
@@ -91,7 +392,7 @@ class ACEStepPipeline:
             truncation=True,
             max_length=text_max_length,
         )
-        inputs = {key: value.to(device) for key, value in inputs.items()}
+        inputs = inputs_to_device(inputs, device)
         if self.text_encoder_model.device != device:
             self.text_encoder_model.to(device)
         with torch.no_grad():
@@ -111,37 +412,25 @@ class ACEStepPipeline:
             truncation=True,
             max_length=text_max_length,
         )
-        inputs = {key: value.to(device) for key, value in inputs.items()}
+        inputs = inputs_to_device(inputs, device)
         if self.text_encoder_model.device != device:
             self.text_encoder_model.to(device)
 
-        def forward_with_temperature(inputs, tau=0.01, l_min=8, l_max=10):
-            handlers = []
-
-            def hook(module, input, output):
-                output[:] *= tau
-                return output
-
-            for i in range(l_min, l_max):
-                handler = (
-                    self.text_encoder_model.encoder.block[i]
-                    .layer[0]
-                    .SelfAttention.q.register_forward_hook(hook)
-                )
-                handlers.append(handler)
-
-            with torch.no_grad():
-                outputs = self.text_encoder_model(**inputs)
-                last_hidden_states = outputs.last_hidden_state
-
-            for hook in handlers:
-                hook.remove()
-
-            return last_hidden_states
-
-        last_hidden_states = forward_with_temperature(inputs, tau, l_min, l_max)
+        # same temperature folding as the ERG diffusion passes; restored even if the forward raises
+        linears = [
+            self.text_encoder_model.encoder.block[i].layer[0].SelfAttention.q
+            for i in range(l_min, l_max)
+        ]
+        with query_temperature(linears, tau), torch.no_grad():
+            outputs = self.text_encoder_model(**inputs)
+            last_hidden_states = outputs.last_hidden_state
         return last_hidden_states
 
+    def clear_graphs(self):
+        # captured graphs read the weights by address, so drop them whenever the weights move or change
+        if self._graphed_decode is not None:
+            self._graphed_decode.reset()
+
     def set_seeds(self, batch_size, manual_seeds=None):
         processed_input_seeds = None
         if manual_seeds is not None:
@@ -155,25 +444,20 @@ class ACEStepPipeline:
                     processed_input_seeds = list(manual_seeds)
             elif isinstance(manual_seeds, int):
                 processed_input_seeds = manual_seeds
+        if processed_input_seeds is None:
+            # draw every random seed with a single RNG call
+            actual_seeds = torch.randint(0, 2**32, (batch_size,)).tolist()
+        elif isinstance(processed_input_seeds, int):
+            actual_seeds = [processed_input_seeds] * batch_size
+        else:
+            # pad a short seed list with its last entry
+            actual_seeds = [
+                processed_input_seeds[min(i, len(processed_input_seeds) - 1)]
+                for i in range(batch_size)
+            ]
         random_generators = [
-            torch.Generator(device=self.device) for _ in range(batch_size)
+            torch.Generator(device=self.device).manual_seed(seed) for seed in actual_seeds
         ]
-        actual_seeds = []
-        for i in range(batch_size):
-            current_seed_for_generator = None
-            if processed_input_seeds is None:
-                current_seed_for_generator = torch.randint(0, 2**32, (1,)).item()
-            elif isinstance(processed_input_seeds, int):
-                current_seed_for_generator = processed_input_seeds
-            elif isinstance(processed_input_seeds, list):
-                if i < len(processed_input_seeds):
-                    current_seed_for_generator = processed_input_seeds[i]
-                else:
-                    current_seed_for_generator = processed_input_seeds[-1]
-            if current_seed_for_generator is None:
-                 current_seed_for_generator = torch.randint(0, 2**32, (1,)).item()
-            random_generators[i].manual_seed(current_seed_for_generator)
-            actual_seeds.append(current_seed_for_generator)
         return random_generators, actual_seeds
 
     def get_lang(self, text):
@@ -188,39 +472,59 @@ class ACEStepPipeline:
             language = "en"
         return language
 
+    def tokenize_line(self, line, debug=False):
+        if STRUCTURE_PATTERN.match(line):
+            # structure tags such as [verse] are always encoded as english
+            lang = "en"
+        else:
+            lang = self.get_lang(line)
+            lang = LANG_ALIASES.get(lang, lang if lang in SUPPORT_LANGUAGES else "en")
+
+        try:
+            token_idx = self.lyric_tokenizer.encode(line, lang)
+            if debug:
+                toks = self.lyric_tokenizer.batch_decode(
+                    [[tok_id] for tok_id in token_idx]
+                )
+                logger.info(f"debbug {line} --> {lang} --> {toks}")
+            return token_idx
+        except Exception as e:
+            print("tokenize error", e, "for line", line, "major_language", lang)
+            return None
+
     def tokenize_lyrics(self, lyrics, debug=False):
         lines = lyrics.split("\n")
         lyric_token_idx = [261]
+        # choruses repeat, so every distinct line is detected and encoded only once
+        line_tokens = {}
         for line in lines:
             line = line.strip()
             if not line:
-                lyric_token_idx += [2]
+                lyric_token_idx.append(2)
                 continue
 
-            lang = self.get_lang(line)
-
-            if lang not in SUPPORT_LANGUAGES:
-                lang = "en"
-            if "zh" in lang:
-                lang = "zh"
-            if "spa" in lang:
-                lang = "es"
+            if line not in line_tokens:
+                line_tokens[line] = self.tokenize_line(line, debug=debug)
+            token_idx = line_tokens[line]
+            if token_idx is not None:
+                lyric_token_idx.extend(token_idx)
+                lyric_token_idx.append(2)
+        return lyric_token_idx
 
-            structure_pattern = re.compile(r"\[.*?\]")
+    def apply_guidance(self, noise_pred, guidance_scale, cfg_type, momentum_buffer=None):
+        if self.compile_guidance and noise_pred.device.type == "cuda":
+            # keep the graph inputs stable: the per-step scale goes in as a tensor, and the
+            # momentum average is a tensor from the first step instead of starting as int 0
+            guidance_scale = torch.tensor(guidance_scale, dtype=torch.float32, device=noise_pred.device)
+            if momentum_buffer is not None and not isinstance(momentum_buffer.running_average, torch.Tensor):
+                momentum_buffer.running_average = torch.zeros_like(noise_pred.chunk(2)[0])
             try:
-                if structure_pattern.match(line):
-                    token_idx = self.lyric_tokenizer.encode(line, "en")
-                else:
-                    token_idx = self.lyric_tokenizer.encode(line, lang)
-                if debug:
-                    toks = self.lyric_tokenizer.batch_decode(
-                        [[tok_id] for tok_id in token_idx]
-                    )
-                    logger.info(f"debbug {line} --> {lang} --> {toks}")
-                lyric_token_idx = lyric_token_idx + token_idx + [2]
+                return compiled_apply_guidance(noise_pred, guidance_scale, cfg_type, momentum_buffer)
             except Exception as e:
-                print("tokenize error", e, "for line", line, "major_language", lang)
-        return lyric_token_idx
+                # e.g. no triton on this install; stay eager for the rest of the session
+                logger.warning(f"compiled guidance unavailable, falling back to eager: {e}")
+                self.compile_guidance = False
+        return apply_guidance(noise_pred, guidance_scale, cfg_type, momentum_buffer)
 
     @cpu_offload("ace_step_transformer")
     def calc_v(
@@ -246,77 +550,69 @@ class ACEStepPipeline:
         momentum_buffer=None,
         momentum_buffer_tar=None,
         return_src_pred=True,
+        latent_buffer=None,
+        merged_conditioning=None,
     ):
+        # fill [src, (src), tar, (tar)] into one reusable buffer instead of torch.cat per step
+        latents = [zt_src, zt_tar] if return_src_pred else [zt_tar]
+        repeats = 2 if do_classifier_free_guidance else 1
+        num_rows = len(latents) * repeats * zt_tar.shape[0]
+        if latent_buffer is None or latent_buffer.shape[0] < num_rows:
+            latent_buffer = zt_tar.new_empty((num_rows, *zt_tar.shape[1:]))
+        latent_model_input = latent_buffer[:num_rows]
+        for j, rows in enumerate(latent_model_input.chunk(len(latents) * repeats)):
+            rows.copy_(latents[j // repeats])
+
         noise_pred_src = None
         if return_src_pred:
-            src_latent_model_input = (
-                torch.cat([zt_src, zt_src]) if do_classifier_free_guidance else zt_src
-            )
-            timestep = t.expand(src_latent_model_input.shape[0])
-            # source
-            noise_pred_src = self.ace_step_transformer(
-                hidden_states=src_latent_model_input,
+            # source and target share the timestep, run them as one batch
+            timestep = t.expand(latent_model_input.shape[0])
+            if merged_conditioning is None:
+                merged_conditioning = merge_src_tar_conditioning(
+                    attention_mask,
+                    encoder_text_hidden_states,
+                    text_attention_mask,
+                    speaker_embds,
+                    lyric_token_ids,
+                    lyric_mask,
+                    target_encoder_text_hidden_states,
+                    target_text_attention_mask,
+                    target_speaker_embeds,
+                    target_lyric_token_ids,
+                    target_lyric_mask,
+                )
+            noise_pred = self.ace_step_transformer(
+                hidden_states=latent_model_input,
+                timestep=timestep,
+                **merged_conditioning,
+            ).sample
+            noise_pred_src, noise_pred_tar = noise_pred.chunk(2)
+        else:
+            timestep = t.expand(latent_model_input.shape[0])
+            # target
+            noise_pred_tar = self.ace_step_transformer(
+                hidden_states=latent_model_input,
                 attention_mask=attention_mask,
-                encoder_text_hidden_states=encoder_text_hidden_states,
-                text_attention_mask=text_attention_mask,
-                speaker_embeds=speaker_embds,
-                lyric_token_idx=lyric_token_ids,
-                lyric_mask=lyric_mask,
+                encoder_text_hidden_states=target_encoder_text_hidden_states,
+                text_attention_mask=target_text_attention_mask,
+                speaker_embeds=target_speaker_embeds,
+                lyric_token_idx=target_lyric_token_ids,
+                lyric_mask=target_lyric_mask,
                 timestep=timestep,
             ).sample
 
-            if do_classifier_free_guidance:
-                noise_pred_with_cond_src, noise_pred_uncond_src = noise_pred_src.chunk(
-                    2
-                )
-                if cfg_type == "apg":
-                    noise_pred_src = apg_forward(
-                        pred_cond=noise_pred_with_cond_src,
-                        pred_uncond=noise_pred_uncond_src,
-                        guidance_scale=guidance_scale,
-                        momentum_buffer=momentum_buffer,
-                    )
-                elif cfg_type == "cfg":
-                    noise_pred_src = cfg_forward(
-                        cond_output=noise_pred_with_cond_src,
-                        uncond_output=noise_pred_uncond_src,
-                        cfg_strength=guidance_scale,
-                    )
-
-        tar_latent_model_input = (
-            torch.cat([zt_tar, zt_tar]) if do_classifier_free_guidance else zt_tar
-        )
-        timestep = t.expand(tar_latent_model_input.shape[0])
-        # target
-        noise_pred_tar = self.ace_step_transformer(
-            hidden_states=tar_latent_model_input,
-            attention_mask=attention_mask,
-            encoder_text_hidden_states=target_encoder_text_hidden_states,
-            text_attention_mask=target_text_attention_mask,
-            speaker_embeds=target_speaker_embeds,
-            lyric_token_idx=target_lyric_token_ids,
-            lyric_mask=target_lyric_mask,
-            timestep=timestep,
-        ).sample
-
         if do_classifier_free_guidance:
-            noise_pred_with_cond_tar, noise_pred_uncond_tar = noise_pred_tar.chunk(2)
-            if cfg_type == "apg":
-                noise_pred_tar = apg_forward(
-                    pred_cond=noise_pred_with_cond_tar,
-                    pred_uncond=noise_pred_uncond_tar,
-                    guidance_scale=target_guidance_scale,
-                    momentum_buffer=momentum_buffer_tar,
-                )
-            elif cfg_type == "cfg":
-                noise_pred_tar = cfg_forward(
-                    cond_output=noise_pred_with_cond_tar,
-                    uncond_output=noise_pred_uncond_tar,
-                    cfg_strength=target_guidance_scale,
+            if noise_pred_src is not None:
+                noise_pred_src = self.apply_guidance(
+                    noise_pred_src, guidance_scale, cfg_type, momentum_buffer
                 )
+            noise_pred_tar = self.apply_guidance(
+                noise_pred_tar, target_guidance_scale, cfg_type, momentum_buffer_tar
+            )
         return noise_pred_src, noise_pred_tar
 
-    @torch.no_grad()
+    @cpu_offload("ace_step_transformer", prefetch="music_dcae")
+    @torch.inference_mode()
     def flowedit_diffusion_process(
         self,
         encoder_text_hidden_states,
@@ -347,66 +643,65 @@ class ACEStepPipeline:
         dtype = encoder_text_hidden_states.dtype
         bsz = encoder_text_hidden_states.shape[0]
 
-        scheduler = FlowMatchEulerDiscreteScheduler(
-            num_train_timesteps=1000,
-            shift=3.0,
-        )
+        scheduler, timesteps, T_steps = get_scheduler("euler", infer_steps, device, dtype)
+        t_norm = timesteps / 1000
+        t_norm_next = torch.cat([t_norm[1:], torch.zeros_like(t_norm[:1])])
 
-        T_steps = infer_steps
         frame_length = src_latents.shape[-1]
-        attention_mask = torch.ones(bsz, frame_length, device=device, dtype=dtype)
-
-        timesteps, T_steps = retrieve_timesteps(
-            scheduler, T_steps, device, timesteps=None
-        )
+        rows = 2 * bsz if do_classifier_free_guidance else bsz
+        attention_mask = self.get_attention_mask(rows, frame_length, device, dtype)
 
         if do_classifier_free_guidance:
-            attention_mask = torch.cat([attention_mask] * 2, dim=0)
-
-            encoder_text_hidden_states = torch.cat(
-                [
-                    encoder_text_hidden_states,
-                    torch.zeros_like(encoder_text_hidden_states),
-                ],
-                0,
-            )
+            encoder_text_hidden_states = with_uncond(encoder_text_hidden_states)
             text_attention_mask = torch.cat([text_attention_mask] * 2, dim=0)
 
-            target_encoder_text_hidden_states = torch.cat(
-                [
-                    target_encoder_text_hidden_states,
-                    torch.zeros_like(target_encoder_text_hidden_states),
-                ],
-                0,
+            target_encoder_text_hidden_states = with_uncond(
+                target_encoder_text_hidden_states
             )
             target_text_attention_mask = torch.cat(
                 [target_text_attention_mask] * 2, dim=0
             )
 
-            speaker_embds = torch.cat(
-                [speaker_embds, torch.zeros_like(speaker_embds)], 0
-            )
-            target_speaker_embeds = torch.cat(
-                [target_speaker_embeds, torch.zeros_like(target_speaker_embeds)], 0
-            )
+            speaker_embds = with_uncond(speaker_embds)
+            target_speaker_embeds = with_uncond(target_speaker_embeds)
 
-            lyric_token_ids = torch.cat(
-                [lyric_token_ids, torch.zeros_like(lyric_token_ids)], 0
-            )
-            lyric_mask = torch.cat([lyric_mask, torch.zeros_like(lyric_mask)], 0)
+            lyric_token_ids = with_uncond(lyric_token_ids)
+            lyric_mask = with_uncond(lyric_mask)
 
-            target_lyric_token_ids = torch.cat(
-                [target_lyric_token_ids, torch.zeros_like(target_lyric_token_ids)], 0
-            )
-            target_lyric_mask = torch.cat(
-                [target_lyric_mask, torch.zeros_like(target_lyric_mask)], 0
-            )
+            target_lyric_token_ids = with_uncond(target_lyric_token_ids)
+            target_lyric_mask = with_uncond(target_lyric_mask)
+
+        # every step x n_avg runs the same src+tar conditioning, so pad and concatenate it once
+        merged_conditioning = merge_src_tar_conditioning(
+            attention_mask,
+            encoder_text_hidden_states,
+            text_attention_mask,
+            speaker_embds,
+            lyric_token_ids,
+            lyric_mask,
+            target_encoder_text_hidden_states,
+            target_text_attention_mask,
+            target_speaker_embeds,
+            target_lyric_token_ids,
+            target_lyric_mask,
+        )
 
         momentum_buffer = MomentumBuffer()
         momentum_buffer_tar = MomentumBuffer()
         x_src = src_latents
-        zt_edit = x_src.clone()
+        # the edited latents stay in fp32 for the whole loop, calc_v casts its inputs
+        zt_edit = x_src.to(torch.float32)
         xt_tar = None
+        # model input workspace shared by every calc_v call: [src, src, tar, tar]
+        latent_buffer = torch.empty(
+            (4 * x_src.shape[0], *x_src.shape[1:]), device=device, dtype=dtype
+        )
+        # reused every step to accumulate the averaged velocity delta
+        V_delta_avg = torch.empty_like(zt_edit)
+        # per-sample workspaces reused by every n_avg iteration
+        fwd_noise_buf = torch.empty(x_src.shape, device=device, dtype=dtype)
+        zt_src_buf = torch.empty_like(x_src)
+        zt_tar_buf = torch.empty_like(zt_edit)
         n_min = int(infer_steps * n_min)
         n_max = int(infer_steps * n_max)
 
@@ -417,27 +712,20 @@ class ACEStepPipeline:
             if i < n_min:
                 continue
 
-            t_i = t / 1000
-
-            if i + 1 < len(timesteps):
-                t_im1 = (timesteps[i + 1]) / 1000
-            else:
-                t_im1 = torch.zeros_like(t_i).to(t_i.device)
+            t_i = t_norm[i]
+            t_im1 = t_norm_next[i]
 
             if i < n_max:
                 # Calculate the average of the V predictions
-                V_delta_avg = torch.zeros_like(x_src)
+                V_delta_avg.zero_()
                 for k in range(n_avg):
-                    fwd_noise = randn_tensor(
-                        shape=x_src.shape,
-                        generator=random_generators,
-                        device=device,
-                        dtype=dtype,
-                    )
+                    fwd_noise = randn_into(fwd_noise_buf, random_generators)
 
-                    zt_src = (1 - t_i) * x_src + (t_i) * fwd_noise
+                    zt_src = torch.lerp(
+                        x_src, fwd_noise, t_i.to(x_src.dtype), out=zt_src_buf
+                    )
 
-                    zt_tar = zt_edit + zt_src - x_src
+                    zt_tar = torch.add(zt_edit, zt_src, out=zt_tar_buf).sub_(x_src)
 
                     Vt_src, Vt_tar = self.calc_v(
                         zt_src=zt_src,
@@ -458,15 +746,15 @@ class ACEStepPipeline:
                         target_guidance_scale=target_guidance_scale,
                         attention_mask=attention_mask,
                         momentum_buffer=momentum_buffer,
+                        latent_buffer=latent_buffer,
+                        merged_conditioning=merged_conditioning,
                     )
-                    V_delta_avg += (1 / n_avg) * (
-                        Vt_tar - Vt_src
+                    V_delta_avg.add_(Vt_tar, alpha=1 / n_avg).sub_(
+                        Vt_src, alpha=1 / n_avg
                     )  # - (hfg-1)*( x_src))
 
                 # propagate direct ODE
-                zt_edit = zt_edit.to(torch.float32)
-                zt_edit = zt_edit + (t_im1 - t_i) * V_delta_avg
-                zt_edit = zt_edit.to(V_delta_avg.dtype)
+                zt_edit = torch.addcmul(zt_edit, V_delta_avg, t_im1 - t_i)
             else:  # i >= T_steps-n_min # regular sampling for last n_min steps
                 if i == n_max:
                     fwd_noise = randn_tensor(
@@ -477,7 +765,7 @@ class ACEStepPipeline:
                     )
                     scheduler._init_step_index(t)
                     sigma = scheduler.sigmas[scheduler.step_index]
-                    xt_src = sigma * fwd_noise + (1.0 - sigma) * x_src
+                    xt_src = torch.lerp(x_src, fwd_noise, sigma.to(x_src.dtype))
                     xt_tar = zt_edit + xt_src - x_src
 
                 _, Vt_tar = self.calc_v(
@@ -500,16 +788,13 @@ class ACEStepPipeline:
                     attention_mask=attention_mask,
                     momentum_buffer_tar=momentum_buffer_tar,
                     return_src_pred=False,
+                    latent_buffer=latent_buffer,
                 )
 
-                dtype = Vt_tar.dtype
-                xt_tar = xt_tar.to(torch.float32)
-                prev_sample = xt_tar + (t_im1 - t_i) * Vt_tar
-                prev_sample = prev_sample.to(dtype)
-                xt_tar = prev_sample
+                xt_tar = torch.addcmul(xt_tar, Vt_tar, t_im1 - t_i)
 
         target_latents = zt_edit if xt_tar is None else xt_tar
-        return target_latents
+        return target_latents.to(dtype)
 
     def add_latents_noise(
         self,
@@ -522,18 +807,24 @@ class ACEStepPipeline:
         bsz = gt_latents.shape[0]
         u = torch.tensor([variance] * bsz, dtype=gt_latents.dtype)
         indices = (u * scheduler.config.num_train_timesteps).long()
-        timesteps = scheduler.timesteps.unsqueeze(1).to(gt_latents.dtype)
-        indices = indices.to(timesteps.device).to(gt_latents.dtype).unsqueeze(1)
-        nearest_idx = torch.argmin(torch.cdist(indices, timesteps), dim=1)
+        timesteps = scheduler.timesteps
+        indices = indices.to(timesteps.device).to(gt_latents.dtype)
+        # timesteps are descending, look up the nearest one in the ascending view
+        ascending = timesteps.flip(0)
+        query = indices.to(ascending.dtype)
+        right = torch.searchsorted(ascending, query).clamp(max=len(ascending) - 1)
+        left = (right - 1).clamp(min=0)
+        use_left = (query - ascending[left]).abs() < (ascending[right] - query).abs()
+        nearest_idx = len(ascending) - 1 - torch.where(use_left, left, right)
         sigma = scheduler.sigmas[nearest_idx].flatten().to(gt_latents.device).to(gt_latents.dtype)
         while len(sigma.shape) < gt_latents.ndim:
             sigma = sigma.unsqueeze(-1)
-        noisy_image = sigma * noise + (1.0 - sigma) * gt_latents
+        noisy_image = torch.lerp(gt_latents, noise, sigma)
         init_timestep = indices[0]
         return noisy_image, init_timestep
 
-    @cpu_offload("ace_step_transformer")
-    @torch.no_grad()
+    @cpu_offload("ace_step_transformer", prefetch="music_dcae")
+    @torch.inference_mode()
     def text2music_diffusion_process(
         self,
         duration,
@@ -568,6 +859,9 @@ class ACEStepPipeline:
         audio2audio_enable=False,
         ref_audio_strength=0.5,
         ref_latents=None,
+        cache_threshold=0.0,
+        use_cuda_graph=False,
+        cfg_skip_steps=(),
     ):
 
         logger.info(
@@ -599,17 +893,6 @@ class ACEStepPipeline:
         dtype = encoder_text_hidden_states.dtype
         bsz = encoder_text_hidden_states.shape[0]
 
-        if scheduler_type == "euler":
-            scheduler = FlowMatchEulerDiscreteScheduler(
-                num_train_timesteps=1000,
-                shift=3.0,
-            )
-        elif scheduler_type == "heun":
-            scheduler = FlowMatchHeunDiscreteScheduler(
-                num_train_timesteps=1000,
-                shift=3.0,
-            )
-
         frame_length = int(duration * 44100 / 512 / 8)
         if src_latents is not None:
             frame_length = src_latents.shape[-1]
@@ -617,36 +900,14 @@ class ACEStepPipeline:
         if ref_latents is not None:
             frame_length = ref_latents.shape[-1]
 
+        scheduler, timesteps, num_inference_steps = get_scheduler(
+            scheduler_type, infer_steps, device, dtype, oss_steps
+        )
         if len(oss_steps) > 0:
             infer_steps = max(oss_steps)
-            scheduler.set_timesteps
-            timesteps, num_inference_steps = retrieve_timesteps(
-                scheduler,
-                num_inference_steps=infer_steps,
-                device=device,
-                timesteps=None,
-            )
-            new_timesteps = torch.zeros(len(oss_steps), dtype=dtype, device=device)
-            for idx in range(len(oss_steps)):
-                new_timesteps[idx] = timesteps[oss_steps[idx] - 1]
-            num_inference_steps = len(oss_steps)
-            sigmas = (new_timesteps / 1000).float().cpu().numpy()
-            timesteps, num_inference_steps = retrieve_timesteps(
-                scheduler,
-                num_inference_steps=num_inference_steps,
-                device=device,
-                sigmas=sigmas,
-            )
             logger.info(
                 f"oss_steps: {oss_steps}, num_inference_steps: {num_inference_steps} after remapping to timesteps {timesteps}"
             )
-        else:
-            timesteps, num_inference_steps = retrieve_timesteps(
-                scheduler,
-                num_inference_steps=infer_steps,
-                device=device,
-                timesteps=None,
-            )
 
         target_latents = randn_tensor(
             shape=(bsz, 8, 16, frame_length),
@@ -689,15 +950,15 @@ class ACEStepPipeline:
             elif not is_extend:
                 # if repaint_end_frame
                 repaint_mask = torch.zeros(
-                    (bsz, 8, 16, frame_length), device=device, dtype=dtype
+                    (bsz, 8, 16, frame_length), device=device, dtype=torch.bool
                 )
-                repaint_mask[:, :, :, repaint_start_frame:repaint_end_frame] = 1.0
+                repaint_mask[:, :, :, repaint_start_frame:repaint_end_frame] = True
                 repaint_noise = (
                     torch.cos(retake_variance) * target_latents
                     + torch.sin(retake_variance) * retake_latents
                 )
                 repaint_noise = torch.where(
-                    repaint_mask == 1.0, repaint_noise, target_latents
+                    repaint_mask, repaint_noise, target_latents
                 )
                 zt_edit = x0.clone()
                 z0 = repaint_noise
@@ -748,30 +1009,28 @@ class ACEStepPipeline:
                     gt_latents = extend_gt_latents
 
                 repaint_mask = torch.zeros(
-                    (bsz, 8, 16, frame_length), device=device, dtype=dtype
+                    (bsz, 8, 16, frame_length), device=device, dtype=torch.bool
                 )
                 if left_pad_frame_length > 0:
-                    repaint_mask[:, :, :, :left_pad_frame_length] = 1.0
-                if right_pad_frame_length > 0:
-                    repaint_mask[:, :, :, -right_pad_frame_length:] = 1.0
-                x0 = gt_latents
-                padd_list = []
-                if left_pad_frame_length > 0:
-                    padd_list.append(retake_latents[:, :, :, :left_pad_frame_length])
-                padd_list.append(
-                    target_latents[
-                        :,
-                        :,
-                        :,
-                        left_trim_length : target_latents.shape[-1] - right_trim_length,
-                    ]
-                )
+                    repaint_mask[:, :, :, :left_pad_frame_length] = True
                 if right_pad_frame_length > 0:
-                    padd_list.append(retake_latents[:, :, :, -right_pad_frame_length:])
-                target_latents = torch.cat(padd_list, dim=-1)
+                    repaint_mask[:, :, :, -right_pad_frame_length:] = True
+                # the trims above leave a strided view; x0 is read on every repaint step
+                x0 = gt_latents.contiguous()
+                # fill the extended noise in place; fp32 since the repaint loop runs in fp32
+                mid_length = target_latents.shape[-1] - left_trim_length - right_trim_length
                 assert (
-                    target_latents.shape[-1] == x0.shape[-1]
+                    left_pad_frame_length + mid_length + right_pad_frame_length == x0.shape[-1]
                 ), f"{target_latents.shape=} {x0.shape=}"
+                extend_latents = torch.empty(x0.shape, device=device, dtype=torch.float32)
+                if left_pad_frame_length > 0:
+                    extend_latents[..., :left_pad_frame_length] = retake_latents[..., :left_pad_frame_length]
+                extend_latents[..., left_pad_frame_length : left_pad_frame_length + mid_length] = target_latents[
+                    ..., left_trim_length : left_trim_length + mid_length
+                ]
+                if right_pad_frame_length > 0:
+                    extend_latents[..., -right_pad_frame_length:] = retake_latents[..., -right_pad_frame_length:]
+                target_latents = extend_latents
                 zt_edit = x0.clone()
                 z0 = target_latents
 
@@ -779,7 +1038,7 @@ class ACEStepPipeline:
         if audio2audio_enable and ref_latents is not None:
             target_latents, init_timestep = self.add_latents_noise(gt_latents=ref_latents, variance=(1-ref_audio_strength), noise=target_latents, scheduler=scheduler)
 
-        attention_mask = torch.ones(bsz, frame_length, device=device, dtype=dtype)
+        attention_mask = self.get_attention_mask(bsz, frame_length, device, dtype)
 
         # guidance interval
         start_idx = int(num_inference_steps * ((1 - guidance_interval) / 2))
@@ -791,24 +1050,12 @@ class ACEStepPipeline:
         momentum_buffer = MomentumBuffer()
 
         def forward_encoder_with_temperature(self, inputs, tau=0.01, l_min=4, l_max=6):
-            handlers = []
-
-            def hook(module, input, output):
-                output[:] *= tau
-                return output
-
-            for i in range(l_min, l_max):
-                handler = self.ace_step_transformer.lyric_encoder.encoders[
-                    i
-                ].self_attn.linear_q.register_forward_hook(hook)
-                handlers.append(handler)
-
-            encoder_hidden_states, encoder_hidden_mask = (
-                self.ace_step_transformer.encode(**inputs)
-            )
-
-            for hook in handlers:
-                hook.remove()
+            encoder = self.ace_step_transformer.lyric_encoder
+            linears = [encoder.encoders[i].self_attn.linear_q for i in range(l_min, l_max)]
+            with query_temperature(linears, tau):
+                encoder_hidden_states, encoder_hidden_mask = (
+                    self.ace_step_transformer.encode(**inputs)
+                )
 
             return encoder_hidden_states
 
@@ -829,10 +1076,10 @@ class ACEStepPipeline:
                     "encoder_text_hidden_states": (
                         encoder_text_hidden_states_null
                         if encoder_text_hidden_states_null is not None
-                        else torch.zeros_like(encoder_text_hidden_states)
+                        else self.get_zeros("text", encoder_text_hidden_states)
                     ),
                     "text_attention_mask": text_attention_mask,
-                    "speaker_embeds": torch.zeros_like(speaker_embds),
+                    "speaker_embeds": self.get_zeros("speaker", speaker_embds),
                     "lyric_token_idx": lyric_token_ids,
                     "lyric_mask": lyric_mask,
                 },
@@ -840,10 +1087,10 @@ class ACEStepPipeline:
         else:
             # P(null_speaker, null_text, null_lyric)
             encoder_hidden_states_null, _ = self.ace_step_transformer.encode(
-                torch.zeros_like(encoder_text_hidden_states),
+                self.get_zeros("text", encoder_text_hidden_states),
                 text_attention_mask,
-                torch.zeros_like(speaker_embds),
-                torch.zeros_like(lyric_token_ids),
+                self.get_zeros("speaker", speaker_embds),
+                self.get_zeros("lyric", lyric_token_ids),
                 lyric_mask,
             )
 
@@ -856,7 +1103,7 @@ class ACEStepPipeline:
                     inputs={
                         "encoder_text_hidden_states": encoder_text_hidden_states,
                         "text_attention_mask": text_attention_mask,
-                        "speaker_embeds": torch.zeros_like(speaker_embds),
+                        "speaker_embeds": self.get_zeros("speaker", speaker_embds),
                         "lyric_token_idx": lyric_token_ids,
                         "lyric_mask": lyric_mask,
                     },
@@ -866,120 +1113,144 @@ class ACEStepPipeline:
                 encoder_hidden_states_no_lyric, _ = self.ace_step_transformer.encode(
                     encoder_text_hidden_states,
                     text_attention_mask,
-                    torch.zeros_like(speaker_embds),
-                    torch.zeros_like(lyric_token_ids),
+                    self.get_zeros("speaker", speaker_embds),
+                    self.get_zeros("lyric", lyric_token_ids),
                     lyric_mask,
                 )
 
         def forward_diffusion_with_temperature(
             self, hidden_states, timestep, inputs, tau=0.01, l_min=15, l_max=20
         ):
-            handlers = []
-
-            def hook(module, input, output):
-                output[:] *= tau
-                return output
-
-            for i in range(l_min, l_max):
-                handler = self.ace_step_transformer.transformer_blocks[
-                    i
-                ].attn.to_q.register_forward_hook(hook)
-                handlers.append(handler)
-                handler = self.ace_step_transformer.transformer_blocks[
-                    i
-                ].cross_attn.to_q.register_forward_hook(hook)
-                handlers.append(handler)
-
-            sample = self.ace_step_transformer.decode(
-                hidden_states=hidden_states, timestep=timestep, **inputs
-            ).sample
-
-            for hook in handlers:
-                hook.remove()
+            blocks = self.ace_step_transformer.transformer_blocks
+            linears = [blocks[i].attn.to_q for i in range(l_min, l_max)]
+            linears += [blocks[i].cross_attn.to_q for i in range(l_min, l_max)]
+            with query_temperature(linears, tau):
+                sample = self.ace_step_transformer.decode(
+                    hidden_states=hidden_states, timestep=timestep, **inputs
+                ).sample
 
             return sample
 
-        for i, t in tqdm(enumerate(timesteps), total=num_inference_steps):
-            if t > init_timestep:
-                continue
-
+        # P(x|speaker, text, lyric), P(x|text, no lyric) and P(x|null) run as one batched forward
+        with_no_lyric = (
+            do_double_condition_guidance
+            and encoder_hidden_states_no_lyric is not None
+        )
+        branches = [encoder_hidden_states]
+        if with_no_lyric:
+            branches.append(encoder_hidden_states_no_lyric)
+        if not use_erg_diffusion:
+            # the erg query temperature applies to the whole batch, so that uncond pass stays separate
+            branches.append(encoder_hidden_states_null)
+        num_branches = len(branches)
+        guided_encoder_hidden_states = torch.cat(branches, dim=0)
+        guided_encoder_hidden_mask = encoder_hidden_mask.repeat(num_branches, 1)
+        guided_attention_mask = self.get_attention_mask(num_branches * bsz, frame_length, device, dtype)
+
+        if use_cuda_graph:
+            # graphs are captured once per input shape and replayed across calls
+            if self._graphed_decode is None:
+                self._graphed_decode = GraphedDecode(self.ace_step_transformer.decode)
+            elif self.cpu_offload:
+                # offloaded weights are uploaded to new addresses on every call
+                self.clear_graphs()
+            guided_decode = cond_decode = self._graphed_decode
+        else:
+            guided_decode = cond_decode = lambda **kwargs: self.ace_step_transformer.decode(**kwargs).sample
+
+        if is_repaint:
+            # the repaint trajectory stays in fp32 and is cast to dtype only for the model input
+            x0, z0, zt_edit = x0.float(), z0.float(), zt_edit.float()
+            # constant across steps, so normalize once
+            t_norm = timesteps / 1000
+            t_norm_next = torch.cat([t_norm[1:], torch.zeros_like(t_norm[:1])])
+
+        # the latent trajectory stays in fp32 across steps; only the model input is cast down
+        target_latents = target_latents.float()
+        step_cache = StepCache(cache_threshold)
+        scheduler.preconfigure(omega=omega_scale)
+        # euler steps line up one to one with the timesteps, so the index is known up front
+        indexed_steps = scheduler.order == 1
+        # per-step timestep batches, indexed by i instead of expanding t every step
+        timesteps_batched = timesteps.unsqueeze(1).expand(-1, bsz).contiguous()
+        timesteps_guided = timesteps.unsqueeze(1).expand(-1, num_branches * bsz).contiguous()
+        # timesteps descend, so audio2audio's noisier steps form a prefix that is never run
+        start_step = int((timesteps > init_timestep).sum())
+        for i, t in tqdm(
+            enumerate(timesteps[start_step:], start=start_step),
+            total=len(timesteps) - start_step,
+        ):
             if is_repaint:
                 if i < n_min:
                     continue
                 elif i == n_min:
-                    t_i = t / 1000
+                    t_i = t_norm[i]
                     zt_src = (1 - t_i) * x0 + (t_i) * z0
                     target_latents = zt_edit + zt_src - x0
                     logger.info(f"repaint start from {n_min} add {t_i} level of noise")
 
             # expand the latents if we are doing classifier free guidance
-            latents = target_latents
+            latents = target_latents.to(dtype)
 
             is_in_guidance_interval = start_idx <= i < end_idx
-            if is_in_guidance_interval and do_classifier_free_guidance:
-                # compute current guidance scale
-                if guidance_interval_decay > 0:
-                    # Linearly interpolate to calculate the current guidance scale
-                    progress = (i - start_idx) / (
-                        end_idx - start_idx - 1
-                    )  # 归一化到[0,1]
-                    current_guidance_scale = (
-                        guidance_scale
-                        - (guidance_scale - min_guidance_scale)
-                        * progress
-                        * guidance_interval_decay
-                    )
-                else:
-                    current_guidance_scale = guidance_scale
+            # compute current guidance scale
+            if is_in_guidance_interval and guidance_interval_decay > 0:
+                # Linearly interpolate to calculate the current guidance scale
+                progress = (i - start_idx) / (
+                    end_idx - start_idx - 1
+                )  # 归一化到[0,1]
+                current_guidance_scale = (
+                    guidance_scale
+                    - (guidance_scale - min_guidance_scale)
+                    * progress
+                    * guidance_interval_decay
+                )
+            else:
+                current_guidance_scale = guidance_scale
 
+            # at scale 1 cfg and apg reduce to the cond prediction, so the uncond pass is wasted
+            skip_uncond = i in cfg_skip_steps or (
+                is_unit_guidance(current_guidance_scale)
+                and cfg_type in ("cfg", "apg")
+                and not do_double_condition_guidance
+            )
+            if is_in_guidance_interval and do_classifier_free_guidance and not skip_uncond:
                 latent_model_input = latents
-                timestep = t.expand(latent_model_input.shape[0])
+                timestep = timesteps_batched[i]
                 output_length = latent_model_input.shape[-1]
-                # P(x|speaker, text, lyric)
-                noise_pred_with_cond = self.ace_step_transformer.decode(
-                    hidden_states=latent_model_input,
-                    attention_mask=attention_mask,
-                    encoder_hidden_states=encoder_hidden_states,
-                    encoder_hidden_mask=encoder_hidden_mask,
-                    output_length=output_length,
-                    timestep=timestep,
-                ).sample
-
-                noise_pred_with_only_text_cond = None
-                if (
-                    do_double_condition_guidance
-                    and encoder_hidden_states_no_lyric is not None
-                ):
-                    noise_pred_with_only_text_cond = self.ace_step_transformer.decode(
-                        hidden_states=latent_model_input,
-                        attention_mask=attention_mask,
-                        encoder_hidden_states=encoder_hidden_states_no_lyric,
-                        encoder_hidden_mask=encoder_hidden_mask,
+                noise_preds = step_cache(
+                    "guided",
+                    latent_model_input,
+                    lambda: guided_decode(
+                        hidden_states=latent_model_input.repeat(num_branches, 1, 1, 1),
+                        attention_mask=guided_attention_mask,
+                        encoder_hidden_states=guided_encoder_hidden_states,
+                        encoder_hidden_mask=guided_encoder_hidden_mask,
                         output_length=output_length,
-                        timestep=timestep,
-                    ).sample
+                        timestep=timesteps_guided[i],
+                    ),
+                ).chunk(num_branches)
+                noise_pred_with_cond = noise_preds[0]
+                noise_pred_with_only_text_cond = noise_preds[1] if with_no_lyric else None
 
                 if use_erg_diffusion:
-                    noise_pred_uncond = forward_diffusion_with_temperature(
-                        self,
-                        hidden_states=latent_model_input,
-                        timestep=timestep,
-                        inputs={
-                            "encoder_hidden_states": encoder_hidden_states_null,
-                            "encoder_hidden_mask": encoder_hidden_mask,
-                            "output_length": output_length,
-                            "attention_mask": attention_mask,
-                        },
+                    noise_pred_uncond = step_cache(
+                        "uncond",
+                        latent_model_input,
+                        lambda: forward_diffusion_with_temperature(
+                            self,
+                            hidden_states=latent_model_input,
+                            timestep=timestep,
+                            inputs={
+                                "encoder_hidden_states": encoder_hidden_states_null,
+                                "encoder_hidden_mask": encoder_hidden_mask,
+                                "output_length": output_length,
+                                "attention_mask": attention_mask,
+                            },
+                        ),
                     )
                 else:
-                    noise_pred_uncond = self.ace_step_transformer.decode(
-                        hidden_states=latent_model_input,
-                        attention_mask=attention_mask,
-                        encoder_hidden_states=encoder_hidden_states_null,
-                        encoder_hidden_mask=encoder_hidden_mask,
-                        output_length=output_length,
-                        timestep=timestep,
-                    ).sample
+                    noise_pred_uncond = noise_preds[-1]
 
                 if (
                     do_double_condition_guidance
@@ -1017,40 +1288,40 @@ class ACEStepPipeline:
                     )
             else:
                 latent_model_input = latents
-                timestep = t.expand(latent_model_input.shape[0])
-                noise_pred = self.ace_step_transformer.decode(
-                    hidden_states=latent_model_input,
-                    attention_mask=attention_mask,
-                    encoder_hidden_states=encoder_hidden_states,
-                    encoder_hidden_mask=encoder_hidden_mask,
-                    output_length=latent_model_input.shape[-1],
-                    timestep=timestep,
-                ).sample
+                timestep = timesteps_batched[i]
+                noise_pred = step_cache(
+                    "cond",
+                    latent_model_input,
+                    lambda: cond_decode(
+                        hidden_states=latent_model_input,
+                        attention_mask=attention_mask,
+                        encoder_hidden_states=encoder_hidden_states,
+                        encoder_hidden_mask=encoder_hidden_mask,
+                        output_length=latent_model_input.shape[-1],
+                        timestep=timestep,
+                    ),
+                )
 
             if is_repaint and i >= n_min:
-                t_i = t / 1000
-                if i + 1 < len(timesteps):
-                    t_im1 = (timesteps[i + 1]) / 1000
-                else:
-                    t_im1 = torch.zeros_like(t_i).to(t_i.device)
-                dtype = noise_pred.dtype
-                target_latents = target_latents.to(torch.float32)
-                prev_sample = target_latents + (t_im1 - t_i) * noise_pred
-                prev_sample = prev_sample.to(dtype)
-                target_latents = prev_sample
-                zt_src = (1 - t_im1) * x0 + (t_im1) * z0
-                target_latents = torch.where(
-                    repaint_mask == 1.0, target_latents, zt_src
+                target_latents = repaint_step(
+                    target_latents, noise_pred, x0, z0, repaint_mask, t_norm[i], t_norm_next[i]
                 )
             else:
+                # step casts its result to the model_output dtype, so hand it fp32 to stay in fp32
                 target_latents = scheduler.step(
-                    model_output=noise_pred,
+                    model_output=noise_pred.float(),
                     timestep=t,
                     sample=target_latents,
                     return_dict=False,
                     omega=omega_scale,
+                    **({"step_index": i} if indexed_steps else {}),
                 )[0]
 
+        if step_cache.skipped > 0:
+            logger.info(f"step cache reused {step_cache.skipped} transformer outputs")
+
+        target_latents = target_latents.to(dtype)
+
         if is_extend:
             if to_right_pad_gt_latents is not None:
                 target_latents = torch.cat(
@@ -1064,7 +1335,6 @@ class ACEStepPipeline:
 
     @cpu_offload("music_dcae")
     def latents2audio(self, latents, target_wav_duration_second=30.0, sample_rate=48000):
-        output_audios = []
         bs = latents.shape[0]
         pred_latents = latents
         with torch.no_grad():
@@ -1072,17 +1342,32 @@ class ACEStepPipeline:
                 _, pred_wavs = self.music_dcae.decode_overlap(pred_latents, sr=sample_rate)
             else:
                 _, pred_wavs = self.music_dcae.decode(pred_latents, sr=sample_rate)
-        pred_wavs = [pred_wav.cpu().float() for pred_wav in pred_wavs]
-        for i in tqdm(range(bs)):
-            output_audio = (pred_wavs[i], sample_rate)
-            output_audios.append(output_audio)
-        return output_audios
+        if (
+            len(pred_wavs) > 0
+            and pred_wavs[0].device.type == "cuda"
+            and all(pred_wav.shape == pred_wavs[0].shape for pred_wav in pred_wavs)
+        ):
+            # one pinned device-to-host copy for the batch instead of a blocking copy per item
+            stacked = torch.stack(pred_wavs)
+            host = torch.empty(stacked.shape, dtype=torch.float32, pin_memory=True)
+            host.copy_(stacked, non_blocking=True)
+            torch.cuda.current_stream(stacked.device).synchronize()
+            pred_wavs = list(host)
+        else:
+            pred_wavs = [pred_wav.cpu().float() for pred_wav in pred_wavs]
+        return [(pred_wavs[i], sample_rate) for i in range(bs)]
 
     @cpu_offload("music_dcae")
-    def infer_latents(self, input_audio_path):
-        if input_audio_path is None:
+    def infer_latents(self, input_audio_path, input_audio=None):
+        if input_audio is not None:
+            # (waveform, sample_rate) already in memory, laid out like load_audio returns it
+            input_audio, sr = input_audio
+            if input_audio.shape[0] == 1:
+                input_audio = input_audio.repeat(2, 1)
+        elif input_audio_path is None:
             return None
-        input_audio, sr = self.music_dcae.load_audio(input_audio_path)
+        else:
+            input_audio, sr = self.music_dcae.load_audio(input_audio_path)
         input_audio = input_audio.unsqueeze(0)
         device, dtype = self.device, self.dtype
         input_audio = input_audio.to(device=device, dtype=dtype)
@@ -1112,26 +1397,37 @@ class ACEStepPipeline:
         audio2audio_enable: bool = False,
         ref_audio_strength: float = 0.5,
         ref_audio_input: str = None,
+        ref_audio_tensor: tuple = None,
         retake_seeds: list = None,
         retake_variance: float = 0.5,
         task: str = "text2music",
         repaint_start: int = 0,
         repaint_end: int = 0,
         src_audio_path: str = None,
+        src_audio_tensor: tuple = None,
         edit_target_prompt: str = None,
         edit_target_lyrics: str = None,
         edit_n_min: float = 0.0,
         edit_n_max: float = 1.0,
         edit_n_avg: int = 1,
+        cache_threshold: float = 0.0,
+        use_cuda_graph: bool = False,
+        cfg_skip_steps: list = None,
         # save_path: str = None,
         # format: str = "wav",
         batch_size: int = 1,
         debug: bool = False,
     ):
 
-        if audio2audio_enable and ref_audio_input is not None:
+        if audio2audio_enable and (ref_audio_input is not None or ref_audio_tensor is not None):
             task = "audio2audio"
 
+        # start the audio uploads now so they run while the prompt and lyrics are encoded
+        if src_audio_tensor is not None:
+            src_audio_tensor = self.audio_to_device("src", src_audio_tensor)
+        if ref_audio_tensor is not None and audio2audio_enable:
+            ref_audio_tensor = self.audio_to_device("ref", ref_audio_tensor)
+
         start_time = time.time()
 
         random_generators, actual_seeds = self.set_seeds(batch_size, manual_seeds)
@@ -1143,17 +1439,21 @@ class ACEStepPipeline:
             oss_steps = []
         
         texts = [prompt]
-        encoder_text_hidden_states, text_attention_mask = self.get_text_embeddings(texts, self.device)
+        encoder_text_hidden_states, text_attention_mask = self.get_cached_embeddings(
+            ("text", prompt), lambda: self.get_text_embeddings(texts, self.device)
+        )
         encoder_text_hidden_states = encoder_text_hidden_states.repeat(batch_size, 1, 1)
         text_attention_mask = text_attention_mask.repeat(batch_size, 1)
 
         encoder_text_hidden_states_null = None
         if use_erg_tag:
-            encoder_text_hidden_states_null = self.get_text_embeddings_null(texts, self.device)
+            encoder_text_hidden_states_null = self.get_cached_embeddings(
+                ("null", prompt), lambda: self.get_text_embeddings_null(texts, self.device)
+            )
             encoder_text_hidden_states_null = encoder_text_hidden_states_null.repeat(batch_size, 1, 1)
 
         # not support for released checkpoint
-        speaker_embeds = torch.zeros(batch_size, 512).to(self.device).to(self.dtype)
+        speaker_embeds = torch.zeros(batch_size, 512, device=self.device, dtype=self.dtype)
 
         # 6 lyric
         lyric_token_idx = torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
@@ -1164,6 +1464,15 @@ class ACEStepPipeline:
             lyric_token_idx = torch.tensor(lyric_token_idx).unsqueeze(0).to(self.device).repeat(batch_size, 1)
             lyric_mask = torch.tensor(lyric_mask).unsqueeze(0).to(self.device).repeat(batch_size, 1)
 
+        if self.compile_model:
+            # bucket the conditioning lengths; padded positions are masked out
+            encoder_text_hidden_states = pad_to_multiple(encoder_text_hidden_states, 64)
+            text_attention_mask = pad_to_multiple(text_attention_mask, 64)
+            if encoder_text_hidden_states_null is not None:
+                encoder_text_hidden_states_null = pad_to_multiple(encoder_text_hidden_states_null, 64)
+            lyric_token_idx = pad_to_multiple(lyric_token_idx, 64)
+            lyric_mask = pad_to_multiple(lyric_mask, 64)
+
         if audio_duration <= 0:
             audio_duration = random.uniform(30.0, 240.0)
             logger.info(f"random audio duration: {audio_duration}")
@@ -1180,13 +1489,18 @@ class ACEStepPipeline:
             repaint_end = audio_duration
         
         src_latents = None
-        if src_audio_path is not None:
+        if src_audio_tensor is not None:
+            assert task in ("repaint", "edit", "extend"), "src_audio_tensor is required for retake/repaint/extend task"
+            src_latents = self.infer_latents(None, src_audio_tensor)
+        elif src_audio_path is not None:
             assert src_audio_path is not None and task in ("repaint", "edit", "extend"), "src_audio_path is required for retake/repaint/extend task"
             assert os.path.exists(src_audio_path), f"src_audio_path {src_audio_path} does not exist"
             src_latents = self.infer_latents(src_audio_path)
 
         ref_latents = None
-        if ref_audio_input is not None and audio2audio_enable:
+        if ref_audio_tensor is not None and audio2audio_enable:
+            ref_latents = self.infer_latents(None, ref_audio_tensor)
+        elif ref_audio_input is not None and audio2audio_enable:
             assert ref_audio_input is not None, "ref_audio_input is required for audio2audio task"
             assert os.path.exists(
                 ref_audio_input
@@ -1195,7 +1509,9 @@ class ACEStepPipeline:
 
         if task == "edit":
             texts = [edit_target_prompt]
-            target_encoder_text_hidden_states, target_text_attention_mask = self.get_text_embeddings(texts, self.device)
+            target_encoder_text_hidden_states, target_text_attention_mask = self.get_cached_embeddings(
+                ("text", edit_target_prompt), lambda: self.get_text_embeddings(texts, self.device)
+            )
             target_encoder_text_hidden_states = target_encoder_text_hidden_states.repeat(batch_size, 1, 1)
             target_text_attention_mask = target_text_attention_mask.repeat(batch_size, 1)
 
@@ -1260,6 +1576,9 @@ class ACEStepPipeline:
                 audio2audio_enable=audio2audio_enable,
                 ref_audio_strength=ref_audio_strength,
                 ref_latents=ref_latents,
+                cache_threshold=cache_threshold,
+                use_cuda_graph=use_cuda_graph,
+                cfg_skip_steps=frozenset(cfg_skip_steps or ()),
             )
 
         end_time = time.time()
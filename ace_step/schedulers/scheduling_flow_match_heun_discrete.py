@@ -27,6 +27,23 @@ from diffusers.schedulers.scheduling_utils import SchedulerMixin
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
 
+def logistic_function(x, L=0.9, U=1.1, x_0=0.0, k=1):
+    # L = Lower bound
+    # U = Upper bound
+    # x_0 = Midpoint (x corresponding to y = 1.0)
+    # k = Steepness, can adjust based on preference
+
+    if isinstance(x, torch.Tensor):
+        device_ = x.device
+        x = x.to(torch.float).cpu().numpy()
+
+    new_x = L + (U - L) / (1 + np.exp(-k * (x - x_0)))
+
+    if isinstance(new_x, np.ndarray):
+        new_x = torch.from_numpy(new_x).to(device_)
+    return new_x
+
+
 @dataclass
 class FlowMatchHeunDiscreteSchedulerOutput(BaseOutput):
     """
@@ -77,6 +94,7 @@ class FlowMatchHeunDiscreteScheduler(SchedulerMixin, ConfigMixin):
 
         self._step_index = None
         self._begin_index = None
+        self._rescaled_omega = None
 
         self.sigmas = sigmas.to("cpu")  # to avoid too much CPU/GPU communication
         self.sigma_min = self.sigmas[-1].item()
@@ -107,6 +125,18 @@ class FlowMatchHeunDiscreteScheduler(SchedulerMixin, ConfigMixin):
         """
         self._begin_index = begin_index
 
+    def preconfigure(self, omega: Union[float, np.array] = 0.0):
+        """
+        Rescales `omega` once ahead of the denoising loop, `step` reuses it while the same value is passed.
+
+        Args:
+            omega (`float` or `np.array`):
+                The omega scale later passed to `step`.
+        """
+        self.omega_bef_rescale = omega
+        self.omega_aft_rescale = logistic_function(omega, k=0.1)
+        self._rescaled_omega = (omega, self.omega_aft_rescale)
+
     def scale_noise(
         self,
         sample: torch.FloatTensor,
@@ -238,25 +268,12 @@ class FlowMatchHeunDiscreteScheduler(SchedulerMixin, ConfigMixin):
                 returned, otherwise a tuple is returned where the first element is the sample tensor.
         """
 
-        def logistic_function(x, L=0.9, U=1.1, x_0=0.0, k=1):
-            # L = Lower bound
-            # U = Upper bound
-            # x_0 = Midpoint (x corresponding to y = 1.0)
-            # k = Steepness, can adjust based on preference
-
-            if isinstance(x, torch.Tensor):
-                device_ = x.device
-                x = x.to(torch.float).cpu().numpy()
-
-            new_x = L + (U - L) / (1 + np.exp(-k * (x - x_0)))
-
-            if isinstance(new_x, np.ndarray):
-                new_x = torch.from_numpy(new_x).to(device_)
-            return new_x
-
-        self.omega_bef_rescale = omega
-        omega = logistic_function(omega, k=0.1)
-        self.omega_aft_rescale = omega
+        if self._rescaled_omega is not None and omega is self._rescaled_omega[0]:
+            omega = self._rescaled_omega[1]
+        else:
+            self.omega_bef_rescale = omega
+            omega = logistic_function(omega, k=0.1)
+            self.omega_aft_rescale = omega
         
         if (
             isinstance(timestep, int)
@@ -0,0 +1,46 @@
+import torch
+
+
+class StepCache:
+    """Reuse transformer outputs between adjacent denoising steps (TeaCache style).
+
+    For every branch the relative L1 change of the transformer input is rescaled
+    and accumulated; while the total stays below `threshold` the previous output
+    is returned instead of running the forward again.
+
+    Experimental and off by default: the change is measured on the raw latents
+    rather than the timestep-modulated input, and the rescale polynomial has not
+    been fitted for ACE-Step, so `threshold` has no calibrated meaning yet. It is
+    only reachable through the pipeline's `cache_threshold` argument, not the nodes.
+    """
+
+    # a0 + a1*x + ... + a4*x^4, rescales the input change into an output change estimate;
+    # identity until coefficients are fitted against recorded input/output changes
+    COEFFICIENTS = (0.0, 1.0, 0.0, 0.0, 0.0)
+
+    def __init__(self, threshold: float = 0.0):
+        self.threshold = threshold
+        self.skipped = 0
+        # branch -> [previous input, accumulated distance, cached output]
+        self._branches = {}
+
+    def rescale(self, distance: float) -> float:
+        return sum(a * distance**i for i, a in enumerate(self.COEFFICIENTS))
+
+    def __call__(self, branch: str, model_input: torch.Tensor, forward):
+        if self.threshold <= 0:
+            return forward()
+
+        state = self._branches.get(branch)
+        if state is not None and state[0].shape == model_input.shape:
+            previous, accumulated, output = state
+            distance = ((model_input - previous).abs().mean() / previous.abs().mean()).item()
+            accumulated += self.rescale(distance)
+            if accumulated < self.threshold:
+                self._branches[branch] = [model_input, accumulated, output]
+                self.skipped += 1
+                return output
+
+        output = forward()
+        self._branches[branch] = [model_input, 0.0, output]
+        return output
@@ -59,6 +59,9 @@ SUPPORT_LANGUAGES = {
     "hi": 6680,
 }
 
+# Detector codes that map onto a supported tokenizer language
+LANG_ALIASES = {"zh-cn": "zh", "zh-tw": "zh", "spa": "es"}
+
 # Regex pattern for structure markers like [Verse], [Chorus], etc.
 structure_pattern = re.compile(r"\[.*?\]")
 
@@ -285,12 +288,7 @@ class Text2MusicDataset(Dataset):
             text = lang_seg["text"]
 
             # Normalize language codes
-            if lang not in SUPPORT_LANGUAGES:
-                lang = "en"
-            if "zh" in lang:
-                lang = "zh"
-            if "spa" in lang:
-                lang = "es"
+            lang = LANG_ALIASES.get(lang, lang if lang in SUPPORT_LANGUAGES else "en")
 
             # Process each line in the segment
             lines = text.split("\n")
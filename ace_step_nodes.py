@@ -1,13 +1,12 @@
-import torchaudio
-import tempfile
-from typing import Optional
 import torch
 import os
 import ast
+import functools
+import threading
 import sys
-import librosa
 
 from transformers import UMT5EncoderModel, AutoTokenizer
+from diffusers.utils import is_accelerate_available
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 if current_dir not in sys.path:
@@ -18,40 +17,18 @@ from ace_step.music_dcae.music_dcae_pipeline import MusicDCAE
 from ace_step.ace_models.ace_step_transformer import ACEStepTransformer2DModel
 
 import folder_paths
-cache_dir = folder_paths.get_temp_directory()
 models_dir = folder_paths.models_dir
 model_path = os.path.join(models_dir, "TTS", "ACE-Step-v1-3.5B")
 
-torch.backends.cudnn.benchmark = False
+# inference shapes stay fixed within a run, so let cudnn autotune instead of forcing deterministic kernels
+torch.backends.cudnn.benchmark = True
 torch.set_float32_matmul_precision('high')
-torch.backends.cudnn.deterministic = True
+torch.backends.cudnn.deterministic = False
 torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 
-def cache_audio_tensor(
-    cache_dir,
-    audio_tensor: torch.Tensor,
-    sample_rate: int,
-    filename_prefix: str = "cached_audio_",
-    audio_format: Optional[str] = ".wav"
-) -> str:
-    try:
-        with tempfile.NamedTemporaryFile(
-            prefix=filename_prefix,
-            suffix=audio_format,
-            dir=cache_dir,
-            delete=False 
-        ) as tmp_file:
-            temp_filepath = tmp_file.name
-        
-        torchaudio.save(temp_filepath, audio_tensor, sample_rate)
-
-        return temp_filepath
-    except Exception as e:
-        raise Exception(f"Error caching audio tensor: {e}")
-
-
 def set_all_seeds(seed):
     # import random
     # import numpy as np
@@ -69,6 +46,13 @@ def set_all_seeds(seed):
         # torch.backends.cudnn.benchmark = False     # 关闭优化（牺牲速度换取确定性）
 
 
+@functools.lru_cache(maxsize=32)
+def parse_parameters(parameters: str) -> tuple:
+    # the same parameters string usually comes back on every queued run;
+    # callers get a fresh dict from the cached items since they modify it
+    return tuple(ast.literal_eval(parameters).items())
+
+
 from ace_step.data_sampler import DataSampler
 
 def sample_data(json_data):
@@ -92,8 +76,28 @@ def sample_data(json_data):
     }
 
 data_sampler = DataSampler()
-json_data = data_sampler.sample()
-jd= sample_data(json_data)
+
+# node defaults, frozen from examples/input_params/default_1.json so importing the nodes reads no json
+DEFAULT_PROMPT = "pop, rap, electronic, blues, hip-house, rhythm and blues"
+DEFAULT_LYRICS = "[verse]\n我走过深夜的街道\n冷风吹乱思念的漂亮外套\n你的微笑像星光很炫耀\n照亮了我孤独的每分每秒\n\n[chorus]\n愿你是风吹过我的脸\n带我飞过最远最遥远的山间\n愿你是风轻触我的梦\n停在心头不再飘散无迹无踪\n\n[verse]\n一起在喧哗避开世俗的骚动\n独自在天台探望月色的朦胧\n你说爱像音乐带点重节奏\n一拍一跳让我忘了心的温度多空洞\n\n[bridge]\n唱起对你的想念不隐藏\n像诗又像画写满藏不了的渴望\n你的影子挥不掉像风的倔强\n追着你飞扬穿越云海一样泛光\n\n[chorus]\n愿你是风吹过我的手\n暖暖的触碰像春日细雨温柔\n愿你是风盘绕我的身\n深情万万重不会有一天走远走\n\n[verse]\n深夜的钢琴弹起动人的旋律\n低音鼓砸进心底的每一次呼吸\n要是能将爱化作歌声传递\n你是否会听见我心里的真心实意"
+DEFAULT_PARAMETERS = {
+    "audio_duration": 170.63997916666668,
+    "infer_step": 60,
+    "guidance_scale": 15,
+    "scheduler_type": "euler",
+    "cfg_type": "apg",
+    "omega_scale": 10,
+    "seed": 3299954530,
+    "guidance_interval": 0.5,
+    "guidance_interval_decay": 0,
+    "min_guidance_scale": 3,
+    "use_erg_tag": True,
+    "use_erg_lyric": True,
+    "use_erg_diffusion": True,
+    "oss_steps": "",
+    "guidance_scale_text": 0.0,
+    "guidance_scale_lyric": 0.0,
+}
 
 device = torch.device("cpu")
 dtype = torch.float32
@@ -109,24 +113,25 @@ class GenerationParameters:
     @classmethod
     def INPUT_TYPES(s):
         return {"required": 
-                    { "audio_duration": ("FLOAT", {"default": jd["audio_duration"], "min": 0.0, "max": 240.0, "step": 1.0, "tooltip": "0 is a random length"}),
-                      "infer_step": ("INT", {"default": jd["infer_step"], "min": 1, "max": 200, "step": 1}),
-                      "guidance_scale": ("FLOAT", {"default": jd["guidance_scale"], "min": 0.0, "max": 200.0, "step": 0.1, "tooltip": "When guidance_scale_lyric > 1 and guidance_scale_text > 1, the guidance scale will not be applied."}),
-                      "scheduler_type": (["euler", "heun"], {"default": jd["scheduler_type"], "tooltip": "euler is recommended. heun will take more time."}),
-                      "cfg_type": (["cfg", "apg", "cfg_star"], {"default": jd["cfg_type"], "tooltip": "apg is recommended. cfg and cfg_star are almost the same."}),
-                      "omega_scale": ("FLOAT", {"default": jd["omega_scale"], "min": -100.0, "max": 100.0, "step": 0.1, "tooltip": "Higher values can reduce artifacts"}),
-                      "seed": ("INT", {"default": jd["seed"], "min": 0, "max": 0xFFFFFFFFFFFFFFFF, "step": 1}),
-                      "guidance_interval": ("FLOAT", {"default": jd["guidance_interval"], "min": 0, "max": 1, "step": 0.01, "tooltip": "0.5 means only apply guidance in the middle steps"}),
-                      "guidance_interval_decay": ("FLOAT", {"default": jd["guidance_interval_decay"], "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "Guidance scale will decay from guidance_scale to min_guidance_scale in the interval. 0.0 means no decay."}),
-                      "min_guidance_scale": ("INT", {"default": jd["min_guidance_scale"], "min": 0, "max": 200, "step": 1}),
-                      "use_erg_tag": ("BOOLEAN", {"default": jd["use_erg_tag"]}),
-                      "use_erg_lyric": ("BOOLEAN", {"default": jd["use_erg_lyric"]}),
-                      "use_erg_diffusion": ("BOOLEAN", {"default": jd["use_erg_diffusion"]}),
-                      "oss_steps": ("STRING", {"default": jd["oss_steps"]}),
-                      "guidance_scale_text": ("FLOAT", {"default": jd["guidance_scale_text"], "min": 0.0, "max": 10.0, "step": 0.1}),
-                      "guidance_scale_lyric": ("FLOAT", {"default": jd["guidance_scale_lyric"], "min": 0.0, "max": 10.0, "step": 0.1}),
+                    { "audio_duration": ("FLOAT", {"default": DEFAULT_PARAMETERS["audio_duration"], "min": 0.0, "max": 240.0, "step": 1.0, "tooltip": "0 is a random length"}),
+                      "infer_step": ("INT", {"default": DEFAULT_PARAMETERS["infer_step"], "min": 1, "max": 200, "step": 1}),
+                      "guidance_scale": ("FLOAT", {"default": DEFAULT_PARAMETERS["guidance_scale"], "min": 0.0, "max": 200.0, "step": 0.1, "tooltip": "When guidance_scale_lyric > 1 and guidance_scale_text > 1, the guidance scale will not be applied."}),
+                      "scheduler_type": (["euler", "heun"], {"default": DEFAULT_PARAMETERS["scheduler_type"], "tooltip": "euler is recommended. heun will take more time."}),
+                      "cfg_type": (["cfg", "apg", "cfg_star"], {"default": DEFAULT_PARAMETERS["cfg_type"], "tooltip": "apg is recommended. cfg and cfg_star are almost the same."}),
+                      "omega_scale": ("FLOAT", {"default": DEFAULT_PARAMETERS["omega_scale"], "min": -100.0, "max": 100.0, "step": 0.1, "tooltip": "Higher values can reduce artifacts"}),
+                      "seed": ("INT", {"default": DEFAULT_PARAMETERS["seed"], "min": 0, "max": 0xFFFFFFFFFFFFFFFF, "step": 1}),
+                      "guidance_interval": ("FLOAT", {"default": DEFAULT_PARAMETERS["guidance_interval"], "min": 0, "max": 1, "step": 0.01, "tooltip": "0.5 means only apply guidance in the middle steps"}),
+                      "guidance_interval_decay": ("FLOAT", {"default": DEFAULT_PARAMETERS["guidance_interval_decay"], "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "Guidance scale will decay from guidance_scale to min_guidance_scale in the interval. 0.0 means no decay."}),
+                      "min_guidance_scale": ("INT", {"default": DEFAULT_PARAMETERS["min_guidance_scale"], "min": 0, "max": 200, "step": 1}),
+                      "use_erg_tag": ("BOOLEAN", {"default": DEFAULT_PARAMETERS["use_erg_tag"]}),
+                      "use_erg_lyric": ("BOOLEAN", {"default": DEFAULT_PARAMETERS["use_erg_lyric"]}),
+                      "use_erg_diffusion": ("BOOLEAN", {"default": DEFAULT_PARAMETERS["use_erg_diffusion"]}),
+                      "oss_steps": ("STRING", {"default": DEFAULT_PARAMETERS["oss_steps"]}),
+                      "guidance_scale_text": ("FLOAT", {"default": DEFAULT_PARAMETERS["guidance_scale_text"], "min": 0.0, "max": 10.0, "step": 0.1}),
+                      "guidance_scale_lyric": ("FLOAT", {"default": DEFAULT_PARAMETERS["guidance_scale_lyric"], "min": 0.0, "max": 10.0, "step": 0.1}),
                     },
                     "optional": {
+                      "use_cuda_graph": ("BOOLEAN", {"default": False, "tooltip": "Capture the transformer step in a CUDA graph and replay it. CUDA only, uses extra VRAM."}),
                     }
                 }
 
@@ -149,7 +154,7 @@ class MultiLinePromptACES:
             "required": {
                 "multi_line_prompt": ("STRING", {
                     "multiline": True, 
-                    "default": json_data["prompt"]}),
+                    "default": DEFAULT_PROMPT}),
                 },
         }
 
@@ -170,7 +175,7 @@ class MultiLineLyrics:
             "required": {
                 "multi_line_prompt": ("STRING", {
                     "multiline": True, 
-                    "default": json_data["lyrics"]}),
+                    "default": DEFAULT_LYRICS}),
                 },
         }
 
@@ -194,7 +199,7 @@ class ACEModelLoader:
                 "ace_step_checkpoint": (models, {"default": "ace_step_transformer"}),
                 "text_encoder_checkpoint": (models, {"default": "umt5-base"}),
                 # "quantized": ("BOOLEAN", {"default": False}),
-                "cpu_offload": ("BOOLEAN", {"default": False}),
+                "cpu_offload": ("BOOLEAN", {"default": True, "tooltip": "Keep the models in CPU memory and stream each one to the GPU while it runs. On by default, as the pipeline always offloaded before this switch took effect. Turn it off to keep all three models resident on the GPU: faster, but it needs VRAM for all of them at once and can run out of memory on small cards."}),
                 "torch_compile": ("BOOLEAN", {"default": False}),
             }
         }
@@ -204,7 +209,7 @@ class ACEModelLoader:
     FUNCTION = "load"
     CATEGORY = "🎤MW/MW-ACE-Step"
 
-    def load(self, dcae_checkpoint, vocoder_checkpoint, ace_step_checkpoint, text_encoder_checkpoint, quantized=False, cpu_offload=False, torch_compile=False):
+    def load(self, dcae_checkpoint, vocoder_checkpoint, ace_step_checkpoint, text_encoder_checkpoint, quantized=False, cpu_offload=True, torch_compile=False):
         dcae_checkpoint = os.path.join(model_path, "music_dcae_f8c8")
         vocoder_checkpoint = os.path.join(model_path, "music_vocoder")
         ace_step_checkpoint = os.path.join(model_path, "ace_step_transformer")
@@ -233,7 +238,11 @@ class ACEModelLoader:
                 ace_step_transformer.to(device).eval().to(dtype)
             )
 
-        text_encoder_model = UMT5EncoderModel.from_pretrained(text_encoder_checkpoint, torch_dtype=dtype)
+        # diffusers already loads the transformer this way when accelerate is installed; transformers
+        # only skips the random fp32 init and fills the weights straight from the checkpoint when asked
+        text_encoder_model = UMT5EncoderModel.from_pretrained(
+            text_encoder_checkpoint, torch_dtype=dtype, low_cpu_mem_usage=is_accelerate_available()
+        )
         if cpu_offload:
             text_encoder_model = text_encoder_model.to("cpu").eval().to(dtype)
         else:
@@ -243,9 +252,15 @@ class ACEModelLoader:
         text_tokenizer = AutoTokenizer.from_pretrained(text_encoder_checkpoint)
 
         if torch_compile:
-            music_dcae = torch.compile(music_dcae)
-            ace_step_transformer = torch.compile(ace_step_transformer)
-            text_encoder_model = torch.compile(text_encoder_model)
+            if device.type == "cuda":
+                # sampling calls decode/encode rather than forward, so a compiled module
+                # would run eagerly; the pipeline compiles those methods when it sees this flag.
+                # music_dcae is likewise only used through encode/decode and is left eager
+                ace_step_transformer.torch_compile = True
+                text_encoder_model = torch.compile(text_encoder_model)
+                print("torch_compile enabled, the first generation includes compilation warmup")
+            else:
+                print(f"torch_compile skipped, it is only enabled on CUDA (device: {device})")
 
         elif quantized:
             from torchao.quantization import (
@@ -256,7 +271,6 @@ class ACEModelLoader:
             group_size = 128
             use_hqq = True
 
-            music_dcae = torch.compile(music_dcae)
             ace_step_transformer = torch.compile(ace_step_transformer)
             text_encoder_model = torch.compile(text_encoder_model)
             
@@ -304,6 +318,9 @@ class ACEModelLoader:
                 text_encoder_checkpoint
             )
 
+        # the pipeline reads this to decide between cpu offload and keeping the weights on device
+        ace_step_transformer.cpu_offload = cpu_offload
+
         models = (
             music_dcae,
             ace_step_transformer,
@@ -339,12 +356,38 @@ class ACELoRALoader:
             adapter_name="zh_rap_lora",
             with_alpha=True,
         )
+        with ap_lock:
+            if ap is not None:
+                # a resident pipeline would otherwise replay graphs captured without the adapter
+                ap.clear_graphs()
         return (models,)
 
 
 ap = None
+ap_signature = None
+ap_lock = threading.Lock()
+
+def get_ap(models, overlapped_decode=False):
+    # one pipeline shared by every node, built under a lock so concurrent runs can't load it twice;
+    # it is rebuilt only when different models are wired in
+    global ap, ap_signature
+    signature = tuple(id(model) for model in models)
+    with ap_lock:
+        if ap is None or ap_signature != signature:
+            if ap is not None:
+                # the loader still references the modules, so move them off the device before dropping them
+                ap.to_cpu()
+                ap.cleanup()
+            ap = AP(*models, overlapped_decode=overlapped_decode)
+            ap_signature = signature
+        # a previous unload_model only parked the weights on the host
+        ap.to_device()
+        ap.overlapped_decode = overlapped_decode
+        return ap
+
+
 class ACEStepGen:
-    files = DataSampler().input_params_files
+    files = data_sampler.input_params_files
     songs = {os.path.basename(file): file for file in files}
 
     @classmethod
@@ -353,7 +396,6 @@ class ACEStepGen:
         return {
             "required": {
                 "models": ("ACE_MODELS",),
-                # "unload_model": ("BOOLEAN", {"default": True}),
                 },
             "optional": {
                 "prompt": ("STRING", {"forceInput": True}),
@@ -363,6 +405,7 @@ class ACEStepGen:
                 "ref_audio_strength": ("FLOAT", {"default": 0.5, "min": 0.01, "max": 1.0, "step": 0.01}),
                 "overlapped_decode": ("BOOLEAN", {"default": False}),
                 "delicious_song": (list(cls.songs.keys()) + ["None"],{"default": "None"}),
+                "unload_model": ("BOOLEAN", {"default": False}),
                 },
         }
 
@@ -380,7 +423,7 @@ class ACEStepGen:
         ref_audio_strength=None, 
         overlapped_decode=False, 
         delicious_song="None",
-        # unload_model=True
+        unload_model=False,
         ):
         
         if delicious_song != "None":
@@ -391,35 +434,34 @@ class ACEStepGen:
             parameters["manual_seeds"] = parameters.pop("seed")
         else:
             assert parameters and prompt and lyrics, "parameters, prompt and lyrics are required"
-            parameters = ast.literal_eval(parameters)
+            parameters = dict(parse_parameters(parameters))
 
-        global ap
-        if ap is None:
-            ap = AP(*models, overlapped_decode=overlapped_decode)
+        ap = get_ap(models, overlapped_decode)
 
         audio2audio_enable = False
-        ref_audio_input = None
+        ref_audio_tensor = None
 
         if ref_audio is not None:
-            ref_audio_path = cache_audio_tensor(cache_dir, ref_audio["waveform"].squeeze(0), ref_audio["sample_rate"], filename_prefix="ref_audio_")
             audio2audio_enable = True
             ref_audio_strength = ref_audio_strength
-            ref_audio_input = ref_audio_path
+            ref_audio_tensor = (ref_audio["waveform"].squeeze(0), ref_audio["sample_rate"])
     
-        audio_output = ap(
-            prompt=prompt, 
-            lyrics=lyrics, 
-            task="audio2audio", 
-            audio2audio_enable=audio2audio_enable, 
-            ref_audio_strength=ref_audio_strength, 
-            ref_audio_input=ref_audio_input, 
-            **parameters
-            )
+        # not inference_mode: the waveform and cached embeddings outlive this call and may be edited in place downstream
+        with torch.no_grad():
+            audio_output = ap(
+                prompt=prompt, 
+                lyrics=lyrics, 
+                task="audio2audio", 
+                audio2audio_enable=audio2audio_enable, 
+                ref_audio_strength=ref_audio_strength, 
+                ref_audio_tensor=ref_audio_tensor, 
+                **parameters
+                )
         audio, sr = audio_output[0][0].unsqueeze(0), audio_output[0][1]
 
-        # if unload_model:
-        #     ap.cleanup()
-        #     ap = None
+        if unload_model:
+            # frees the VRAM but keeps the pipeline, so the next run skips reloading from disk
+            ap.to_cpu()
         
         return ({"waveform": audio, "sample_rate": sr}, prompt, lyrics)
 
@@ -439,8 +481,8 @@ class ACEStepRepainting:
                 "repaint_end": ("INT", {"default": 0, "min": 0, "max": 1000, "step": 1}),
                 "repaint_variance": ("FLOAT", {"default": 0.01, "min": 0.01, "max": 1.0, "step": 0.01}),
                 "seed": ("INT", {"default":0, "min": 0, "max": 0xFFFFFFFFFFFFFFFF, "step": 1}),
-                # "unload_model": ("BOOLEAN", {"default": True}),
                 "overlapped_decode": ("BOOLEAN", {"default": False}),
+                "unload_model": ("BOOLEAN", {"default": False}),
                 },
         }
 
@@ -459,41 +501,40 @@ class ACEStepRepainting:
         repaint_end, 
         repaint_variance, 
         seed, 
-        # unload_model=True, 
-        overlapped_decode=False
+        overlapped_decode=False,
+        unload_model=False,
         ):
         if seed != 0:
             set_all_seeds(seed)
         retake_seeds = [str(seed)]
 
-        src_audio_path = cache_audio_tensor(cache_dir, src_audio["waveform"].squeeze(0), src_audio["sample_rate"], filename_prefix="src_audio_")
+        src_audio_tensor = (src_audio["waveform"].squeeze(0), src_audio["sample_rate"])
         
-        audio_duration = librosa.get_duration(filename=src_audio_path)
+        audio_duration = src_audio["waveform"].shape[-1] / src_audio["sample_rate"]
         if repaint_end > audio_duration:
             repaint_end = audio_duration
 
-        parameters = ast.literal_eval(parameters)
+        parameters = dict(parse_parameters(parameters))
         parameters["audio_duration"] = audio_duration
-        global ap
-        if ap is None:
-            ap = AP(*models, overlapped_decode=overlapped_decode)
-
-        audio_output = ap(
-            prompt=prompt, 
-            lyrics=lyrics, 
-            task="repaint", 
-            retake_seeds=retake_seeds, 
-            src_audio_path=src_audio_path, 
-            repaint_start=repaint_start, 
-            repaint_end=repaint_end, 
-            retake_variance=repaint_variance, 
-            **parameters)
+        ap = get_ap(models, overlapped_decode)
+
+        with torch.no_grad():
+            audio_output = ap(
+                prompt=prompt, 
+                lyrics=lyrics, 
+                task="repaint", 
+                retake_seeds=retake_seeds, 
+                src_audio_tensor=src_audio_tensor, 
+                repaint_start=repaint_start, 
+                repaint_end=repaint_end, 
+                retake_variance=repaint_variance, 
+                **parameters)
             
         audio, sr = audio_output[0][0].unsqueeze(0), audio_output[0][1]
 
-        # if unload_model:
-        #     ap.cleanup()
-        #     ap = None
+        if unload_model:
+            # frees the VRAM but keeps the pipeline, so the next run skips reloading from disk
+            ap.to_cpu()
         
         return ({"waveform": audio, "sample_rate": sr},)
 
@@ -514,8 +555,8 @@ class ACEStepEdit:
                 "edit_n_min": ("FLOAT", {"default": 0.6, "min": 0.0, "max": 1.0, "step": 0.01}),
                 "edit_n_max": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01}),
                 "seed": ("INT", {"default":0, "min": 0, "max": 0xFFFFFFFFFFFFFFFF, "step": 1}),
-                # "unload_model": ("BOOLEAN", {"default": True}),
                 "overlapped_decode": ("BOOLEAN", {"default": False}),
+                "unload_model": ("BOOLEAN", {"default": False}),
                 },
         }
 
@@ -535,39 +576,38 @@ class ACEStepEdit:
         edit_n_min, 
         edit_n_max, 
         seed, 
-        # unload_model=True, 
-        overlapped_decode=False
+        overlapped_decode=False,
+        unload_model=False,
         ):
         if seed!= 0:
             set_all_seeds(seed)
         retake_seeds = [str(seed)]
 
-        src_audio_path = cache_audio_tensor(cache_dir, src_audio["waveform"].squeeze(0), src_audio["sample_rate"], filename_prefix="src_audio_")
+        src_audio_tensor = (src_audio["waveform"].squeeze(0), src_audio["sample_rate"])
         
-        audio_duration = librosa.get_duration(filename=src_audio_path)
-        parameters = ast.literal_eval(parameters)
+        audio_duration = src_audio["waveform"].shape[-1] / src_audio["sample_rate"]
+        parameters = dict(parse_parameters(parameters))
         parameters["audio_duration"] = audio_duration
-        global ap
-        if ap is None:
-            ap = AP(*models, overlapped_decode=overlapped_decode)
-
-        audio_output = ap(
-            prompt=prompt, 
-            lyrics=lyrics, 
-            task="edit", 
-            retake_seeds=retake_seeds, 
-            src_audio_path=src_audio_path, 
-            edit_target_prompt = edit_prompt,
-            edit_target_lyrics = edit_lyrics,
-            edit_n_min = edit_n_min,
-            edit_n_max = edit_n_max,
-            **parameters)
+        ap = get_ap(models, overlapped_decode)
+
+        with torch.no_grad():
+            audio_output = ap(
+                prompt=prompt, 
+                lyrics=lyrics, 
+                task="edit", 
+                retake_seeds=retake_seeds, 
+                src_audio_tensor=src_audio_tensor, 
+                edit_target_prompt = edit_prompt,
+                edit_target_lyrics = edit_lyrics,
+                edit_n_min = edit_n_min,
+                edit_n_max = edit_n_max,
+                **parameters)
             
         audio, sr = audio_output[0][0].unsqueeze(0), audio_output[0][1]
 
-        # if unload_model:
-        #     ap.cleanup()
-        #     ap = None
+        if unload_model:
+            # frees the VRAM but keeps the pipeline, so the next run skips reloading from disk
+            ap.to_cpu()
         
         return ({"waveform": audio, "sample_rate": sr},)
 
@@ -587,8 +627,8 @@ class ACEStepExtend:
                 "right_extend_length": ("INT", {"default": 0, "min": 0, "max": 1000, "step": 1}),
                 # "repaint_variance": ("FLOAT", {"default": 0.01, "min": 0.01, "max": 1.0, "step": 0.01}),
                 "seed": ("INT", {"default":0, "min": 0, "max": 0xFFFFFFFFFFFFFFFF, "step": 1}),
-                # "unload_model": ("BOOLEAN", {"default": True}),
                 "overlapped_decode": ("BOOLEAN", {"default": False}),
+                "unload_model": ("BOOLEAN", {"default": False}),
                 },
         }
 
@@ -606,45 +646,73 @@ class ACEStepExtend:
         left_extend_length, 
         right_extend_length, 
         seed, 
-        # unload_model=True, 
-        overlapped_decode=False
+        overlapped_decode=False,
+        unload_model=False,
         ):
         if seed!= 0:
             set_all_seeds(seed)
         retake_seeds = [str(seed)]
 
-        src_audio_path = cache_audio_tensor(cache_dir, src_audio["waveform"].squeeze(0), src_audio["sample_rate"], filename_prefix="src_audio_")
+        src_audio_tensor = (src_audio["waveform"].squeeze(0), src_audio["sample_rate"])
         
-        audio_duration = librosa.get_duration(filename=src_audio_path)
+        audio_duration = src_audio["waveform"].shape[-1] / src_audio["sample_rate"]
         repaint_start = -left_extend_length
         repaint_end = audio_duration + right_extend_length
 
-        parameters = ast.literal_eval(parameters)
+        parameters = dict(parse_parameters(parameters))
         parameters["audio_duration"] = audio_duration
-        global ap
-        if ap is None:
-            ap = AP(*models, overlapped_decode=overlapped_decode)
-
-        audio_output = ap(
-            prompt=prompt, 
-            lyrics=lyrics, 
-            task="extend", 
-            retake_seeds=retake_seeds, 
-            src_audio_path=src_audio_path, 
-            repaint_start=repaint_start, 
-            repaint_end=repaint_end, 
-            retake_variance=1.0,
-            **parameters)
+        ap = get_ap(models, overlapped_decode)
+
+        with torch.no_grad():
+            audio_output = ap(
+                prompt=prompt, 
+                lyrics=lyrics, 
+                task="extend", 
+                retake_seeds=retake_seeds, 
+                src_audio_tensor=src_audio_tensor, 
+                repaint_start=repaint_start, 
+                repaint_end=repaint_end, 
+                retake_variance=1.0,
+                **parameters)
             
         audio, sr = audio_output[0][0].unsqueeze(0), audio_output[0][1]
 
-        # if unload_model:
-        #     ap.cleanup()
-        #     ap = None
+        if unload_model:
+            # frees the VRAM but keeps the pipeline, so the next run skips reloading from disk
+            ap.to_cpu()
         
         return ({"waveform": audio, "sample_rate": sr},)
 
 
+class ACEStepUnload:
+    @classmethod
+    def INPUT_TYPES(cls):
+               
+        return {
+            "required": {
+                "music": ("AUDIO",),
+                },
+        }
+
+    CATEGORY = "🎤MW/MW-ACE-Step"
+    RETURN_TYPES = ("AUDIO",)
+    RETURN_NAMES = ("music",)
+    FUNCTION = "unload"
+    
+    def unload(self, music):
+        # the pipeline stays resident between runs; wire this in after a generation to free its buffers
+        global ap, ap_signature
+        with ap_lock:
+            if ap is not None:
+                # the loader still references the modules, so move them off the device before dropping them
+                ap.to_cpu()
+                ap.cleanup()
+                ap = None
+                ap_signature = None
+        
+        return (music,)
+
+
 from .text2lyric import LyricsLangSwitch
 
 NODE_CLASS_MAPPINGS = {
@@ -658,6 +726,7 @@ NODE_CLASS_MAPPINGS = {
     "ACEStepRepainting": ACEStepRepainting,
     "ACEStepEdit": ACEStepEdit,
     "ACEStepExtend": ACEStepExtend,
+    "ACEStepUnload": ACEStepUnload,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
@@ -671,4 +740,5 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "ACEStepRepainting": "ACE-Step Repainting",
     "ACEStepEdit": "ACE-Step Edit",
     "ACEStepExtend": "ACE-Step Extend",
+    "ACEStepUnload": "ACE-Step Unload",
 }
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+# the repo root is itself a ComfyUI package, so put it on the path like the nodes module does
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root_dir not in sys.path:
+    sys.path.append(root_dir)
+
+torch = pytest.importorskip("torch")
+
+from ace_step.apg_guidance import cfg_forward, is_unit_guidance
+
+
+def test_unit_guidance_only_at_one():
+    assert is_unit_guidance(1.0)
+    assert is_unit_guidance(1.0 + 1e-5)
+    assert not is_unit_guidance(1.5)
+
+
+@pytest.mark.parametrize("scale", [0.5, 0.0])
+def test_scale_below_one_keeps_uncond(scale):
+    # the uncond pass must not be skipped below 1: the result is not the cond prediction
+    assert not is_unit_guidance(scale)
+    cond = torch.ones(1, 8, 4, 4)
+    uncond = torch.zeros(1, 8, 4, 4)
+    out = cfg_forward(cond_output=cond, uncond_output=uncond, cfg_strength=scale)
+    assert torch.allclose(out, uncond + scale * (cond - uncond))
+    assert not torch.allclose(out, cond)
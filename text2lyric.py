@@ -1,4 +1,5 @@
 import re
+import functools
 from loguru import logger
 import os
 import sys
@@ -20,6 +21,11 @@ SUPPORT_LANGUAGES = {
     "ko": 6152, "hi": 6680
 }
 
+# detector codes that map onto a supported tokenizer language
+LANG_ALIASES = {"zh-cn": "zh", "zh-tw": "zh", "spa": "es"}
+
+STRUCTURE_PATTERN = re.compile(r"^\[.*?\]")
+
 lang_segment.setfilters([
             'af', 'am', 'an', 'ar', 'as', 'az', 'be', 'bg', 'bn', 'br', 'bs', 'ca', 'cs', 'cy', 'da', 'de', 'dz', 'el',
             'en', 'eo', 'es', 'et', 'eu', 'fa', 'fi', 'fo', 'fr', 'ga', 'gl', 'gu', 'he', 'hi', 'hr', 'ht', 'hu', 'hy',
@@ -30,6 +36,7 @@ lang_segment.setfilters([
         ])
 
 
+@functools.lru_cache(maxsize=512)
 def get_lang(text):
     language = "en"
     try:
@@ -42,34 +49,32 @@ def get_lang(text):
         language = "en"
     return language
 
+# choruses repeat within and across songs, so each distinct line is detected and tokenized once
+@functools.lru_cache(maxsize=512)
+def tokenize_line(line):
+    lang = get_lang(line)
+    lang = LANG_ALIASES.get(lang, lang if lang in SUPPORT_LANGUAGES else "en")
+
+    try:
+        if STRUCTURE_PATTERN.match(line):
+            token_idx = lyric_tokenizer.preprocess_text(line, "en")
+            return token_idx + "\n"
+        token_idx = lyric_tokenizer.preprocess_text(line, lang)
+        return f"[{lang}]" + token_idx + "\n"
+    except Exception as e:
+        print("tokenize error", e, "for line", line, "major_language", lang)
+        return ""
+
 def tokenize_lyrics(lyrics):
     lines = lyrics.split("\n")
     lyric_token_idx = []
     for line in lines:
         line = line.strip()
         if not line:
-            lyric_token_idx += ["\n"]
+            lyric_token_idx.append("\n")
             continue
 
-        lang = get_lang(line)
-
-        if lang not in SUPPORT_LANGUAGES:
-            lang = "en"
-        if "zh" in lang:
-            lang = "zh"
-        if "spa" in lang:
-            lang = "es"
-
-        structure_pattern = re.compile(r"\[.*?\]")
-        try:
-            if structure_pattern.match(line):
-                token_idx = lyric_tokenizer.preprocess_text(line, "en")
-                lyric_token_idx.append(token_idx + "\n")
-            else:
-                token_idx = lyric_tokenizer.preprocess_text(line, lang)
-                lyric_token_idx.append(f"[{lang}]" + token_idx + "\n")
-        except Exception as e:
-            print("tokenize error", e, "for line", line, "major_language", lang)
+        lyric_token_idx.append(tokenize_line(line))
 
     return "".join(lyric_token_idx)
 